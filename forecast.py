@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# rolling live forecast: warm-starts the model from current plant state, forecasts the next days and publishes alerts
+# the model, its schedules and derived parameters are only built once, every refresh just overwrites the forecast span
+
+import json
+import os
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import inputs
+import historian
+import main
+
+
+def state_time(state):
+    # returns time of plant state as unix epoch, either from epoch itself or from local time string
+    if isinstance(state['time'], str):
+        return inputs.parse_time(state['time'])
+    return float(state['time'])
+
+
+def format_time(t):
+    # returns local time string of unix epoch
+    return datetime.fromtimestamp(t, inputs.triumf_tz).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def warm_start(state):
+    # writes plant state into the model at the step it was measured at and returns that step
+    # state keys are the same as keys of inputs.historian_tags, plus optional 'purchased_dewars' list of
+    # (experiment, level [L]) pairs for experiments fed by purchased dewars and optional 'transfer_trickle'
+    step = int((state_time(state) - inputs.start_time) // main.dt)
+    if not 1 <= step < main.total_steps - 1:
+        raise ValueError(f'plant state at {state["time"]} is outside of modelled period '
+                         f'{format_time(inputs.start_time)} to {format_time(inputs.end_time)}, '
+                         f'start_time and end_time of inputs.py need to cover it')
+    raw = {tag: np.array([state.get(tag, np.nan)], dtype=float) for tag in inputs.historian_tags if tag != 'time'}
+    measured = historian.to_model_units(raw)
+    missing = [k for k in ['hp', 'bag', 'dewar', 'ucn'] if not np.isfinite(measured[k][0])]
+    missing += [f'dewar_{d}_L' for d in main.dewars_list if not np.isfinite(measured['dewar_storage'][d][0])]
+    if len(missing) > 0:
+        raise ValueError(f'plant state is missing {", ".join(missing)}')
+    # indexes of experiments and dewars are checked before anything is written, so a bad state leaves the model as is
+    dewar_fill = measured['dewar_fill'][0]
+    if np.isfinite(dewar_fill) and dewar_fill not in range(-1, inputs.N_dewars):
+        raise ValueError(f'plant state is filling unknown dewar {dewar_fill:g}')
+    fed = [c.item() for c in measured['dewar_cmms'][:, 0] if np.isfinite(c) and c != -1]
+    purchased = state.get('purchased_dewars', [])
+    if len(purchased) > inputs.N_dewars_purchased_max:
+        raise ValueError(f'plant state has {len(purchased)} purchased dewars, more than N_dewars_purchased_max')
+    for p in purchased:
+        if not isinstance(p, (list, tuple)) or len(p) != 2 or not isinstance(p[1], (int, float)) or \
+                not 0 <= p[1] < np.inf:
+            raise ValueError(f'plant state has purchased dewar {p}, expected (experiment, level [L]) pair')
+        fed.append(p[0])
+    unknown = [c for c in fed if c not in range(main.total_cmms)]
+    if len(unknown) > 0:
+        raise ValueError(f'plant state feeds unknown experiments {unknown}')
+    if len(set(fed)) < len(fed):
+        raise ValueError('plant state feeds an experiment from more than one dewar')
+    # forget everything that happened before, including the previous forecast
+    main.linde_state_logbook.clear()
+    main.dewar_state_logbook.clear()
+    main.ucn_state_logbook.clear()
+    del main.cmms_state_logbook[:]
+    main.linde_plan.clear()
+    main.simulated_ahead.value = 0
+    # linde storage
+    main.linde_storage[step] = (measured['hp'][0], measured['bag'][0], measured['dewar'][0], measured['ucn'][0], 0.0)
+    main.linde_production[step] = 0.0
+    main.hp_comp_state[:, step] = main.linde_storage['bag'][step] > inputs.M_bag_setpoints_high
+    # ucn: unknown states are taken from schedule, cooldown is counted from the last scheduled start
+    ucn_source = measured['ucn_source'][0] == 1 if np.isfinite(measured['ucn_source'][0]) else \
+        main.is_this_thing_on(step, 'ucn_source')
+    ucn_beam = measured['ucn_beam'][0] == 1 if np.isfinite(measured['ucn_beam'][0]) else \
+        main.is_this_thing_on(step, 'ucn_beam')
+    scheduled = main.schedule_on['ucn_source'][:step+1]
+    starts = np.flatnonzero(scheduled[1:] & ~scheduled[:-1]) + 1
+    ucn_started = starts[-1] if len(starts) > 0 and scheduled[-1] else 0
+    main.ucn_state[step] = 0
+    main.set_ucn('static', step, ucn_source)
+    main.set_ucn('beam', step, ucn_beam)
+    main.set_ucn('cooldown', step, ucn_source and main.timestamps[step] - main.timestamps[ucn_started] <
+                 inputs.t_ucn_cooldown)
+    main.ucn_state_logbook['static_1'] = ucn_started
+    # linde: if running, it is considered to be fully ramped up
+    linde_run = measured['linde_run'][0] == 1
+    dewar_fill = int(measured['dewar_fill'][0]) if np.isfinite(measured['dewar_fill'][0]) else -1
+    ucn_transfer = measured['ucn_transfer'][0] == 1
+    main.linde_state[step] = 0
+    main.set_linde('run', step, linde_run)
+    main.set_linde('transfer', step, ucn_transfer)
+    main.set_linde('filling', step, dewar_fill != -1)
+    # trickle flow isn't in the historian, unless given it's assumed to only keep transfer line cold for running ucn
+    main.set_linde('transfer_trickle', step, state.get('transfer_trickle', ucn_source and not ucn_transfer))
+    main.linde_state_logbook['run_0'] = 0
+    if linde_run:
+        main.linde_state_logbook['run_1'] = 0
+    # portable dewars and experiments they feed
+    main.cmms_state[:, step] = -1
+    for d in main.dewars_list:
+        level = measured['dewar_storage'][d][0]
+        cmms = measured['dewar_cmms'][d][0]
+        main.dewar_storage[d][step] = max(level, 0.0)
+        main.dewar_cooldown[d] = 0.0
+        if dewar_fill == d:
+            main.change_dewar_state(d, 'fill', step)
+        elif np.isfinite(cmms) and cmms >= 0:
+            main.cmms_state[int(cmms)][step] = d
+            main.change_dewar_state(d, 'cmms', step)
+        elif level <= 0:
+            main.change_dewar_state(d, 'warm', step)
+        else:
+            main.change_dewar_state(d, 'store', step)
+    # purchased dewars
+    purchased = state.get('purchased_dewars', [])
+    main.purchased_dewar_storage[:, step] = 0.0
+    main.purchased_dewar_step[:] = -1
+    main.dewars_purchased.value = len(purchased)
+    for k, (cmms, level_L) in enumerate(purchased):
+        main.purchased_dewar_storage[k][step] = level_L * 1e-3 * inputs.d_portable_dewar
+        main.purchased_dewar_step[k] = step
+        main.cmms_state[int(cmms)][step] = main.purchased_dewar_offset + k
+    return step
+
+
+def find_alerts(step_from, step_to, dewars_purchased_before):
+    # returns alerts about the forecasted span as (step, message) tuples, in chronological order
+    alerts = []
+    new_purchases = main.purchased_dewar_step[dewars_purchased_before:main.dewars_purchased.value]
+    if len(new_purchases) > 0:
+        alerts.append((new_purchases[0], f'dewar purchase likely ({len(new_purchases)} dewars within forecast)'))
+    checks = [(main.linde_storage['bag'][step_from:step_to] >= inputs.M_bag_max, 'bag will vent'),
+              (main.linde_storage['ucn'][step_from:step_to] < 0, 'ucn will run out of helium'),
+              (main.linde_storage['hp'][step_from:step_to] < inputs.M_hp_storage_min, 'hp storage will run low'),
+              (np.any((main.dewar_state[:, step_from+1:step_to] == main.dewar_states['warm']) &
+                      (main.dewar_state[:, step_from:step_to-1] != main.dewar_states['warm']), axis=0),
+               'dewar will warm up')]
+    for happens, msg in checks:
+        if np.any(happens):
+            alerts.append((step_from + int(np.argmax(happens)), msg))
+    return sorted(alerts, key=lambda a: a[0])
+
+
+def forecast(state):
+    # warm-starts the model from plant state, simulates the next t_forecast and returns alerts as dicts
+    step_from = warm_start(state)
+    step_to = min(step_from + int(inputs.t_forecast / main.dt) + 1, main.total_steps)
+    dewars_purchased_before = main.dewars_purchased.value
+    # model grid is fixed by inputs.py, so forecasts close to its end can't cover the whole t_forecast
+    truncated = step_to < step_from + int(inputs.t_forecast / main.dt) + 1
+    stopped = None
+    try:
+        try:
+            for i in range(step_from + 1, step_to):
+                main.iterate(i)
+        except main.IterationStopped as e:
+            stopped = (e.step, str(e))
+            step_to = e.step
+        # forecast span is audited either way, an inconsistency found by the audit comes before whatever stopped it
+        main.audit(step_from + 1, step_to, step_from)
+    except main.InconsistentState as e:
+        stopped = (e.step, str(e))
+        step_to = e.step
+    alerts = find_alerts(step_from, step_to, dewars_purchased_before)
+    if stopped is not None:
+        alerts.append(stopped)
+    elif truncated:
+        alerts.append((step_to - 1, 'forecast cut short by end of modelled period, end_time of inputs.py needs '
+                                    'to be later'))
+    return [{'time': format_time(main.timestamps[step]),
+             'in_hours': round((main.timestamps[step] - main.timestamps[step_from]) / 3600, 1),
+             'alert': msg} for step, msg in alerts]
+
+
+def publish(state, alerts):
+    # writes alerts to inputs.forecast_alerts_file, replacing the file at once so readers never see half of it
+    with open(inputs.forecast_alerts_file + '.tmp', 'w') as f:
+        json.dump({'forecast_from': format_time(state_time(state)), 'alerts': alerts}, f, indent=2)
+    os.replace(inputs.forecast_alerts_file + '.tmp', inputs.forecast_alerts_file)
+    for a in alerts:
+        print(f'{a["time"]} (in {a["in_hours"]} h): {a["alert"]}')
+
+
+if __name__ == "__main__":
+    # re-forecasts whenever plant state file is updated
+    # usage: python forecast.py [state.json]
+    state_file = sys.argv[1] if len(sys.argv) > 1 else inputs.forecast_state_file
+    main.verbose.value = False
+    last_modified = None
+    while True:
+        modified = os.path.getmtime(state_file) if os.path.exists(state_file) else None
+        if modified is not None and modified != last_modified:
+            last_modified = modified
+            started = time.time()
+            try:
+                with open(state_file) as f:
+                    state = json.load(f)
+                publish(state, forecast(state))
+                print(f'forecast from {state["time"]} refreshed in {time.time() - started:.1f} s')
+            except (ValueError, KeyError) as e:  # bad state shouldn't kill the daemon, next update may be fine
+                print(f'forecast failed: {e}')
+        time.sleep(inputs.t_forecast_refresh)
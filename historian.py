@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# streaming ingestion of plant historian csv exports, calibration of loss and rate constants against them
+# and preparation of measured states for replay by the model
+
+import itertools
+import sys
+import numpy as np
+import inputs
+import thermophysical
+
+# measured states, as opposed to measured amounts, are not averaged over timestep and hold until they change
+discrete_tags = {'linde_run', 'ucn_source', 'ucn_beam', 'ucn_transfer', 'dewar_fill'} | \
+                {f'dewar_{d}_cmms' for d in range(inputs.N_dewars)}
+
+
+def parse_times(raw):
+    # converts time column of historian export to unix epoch, either from epoch itself or from local time strings
+    try:
+        return raw.astype(float)
+    except ValueError:
+        pass
+    naive = raw.astype('datetime64[s]').astype(np.int64)  # local time treated as if it was utc
+    # utc offset only changes on daylight saving time switches, so unless chunk contains one it's the same for all rows
+    offset_first = inputs.parse_time(raw[0]) - naive[0]
+    offset_last = inputs.parse_time(raw[-1]) - naive[-1]
+    if offset_first == offset_last:
+        return (naive + offset_first).astype(float)
+    return np.array([inputs.parse_time(x) for x in raw], dtype=float)
+
+
+def read_chunks(path, chunk_rows=inputs.historian_chunk_rows):
+    # yields historian csv export by chunks of at most chunk_rows rows as dicts of tag: ndarray
+    # only columns listed in inputs.historian_tags are read, missing values become NaN
+    with open(path) as f:
+        header = [col.strip() for col in f.readline().strip().split(',')]
+        time_col = header.index(inputs.historian_tags['time'])
+        tags = [tag for tag, col in inputs.historian_tags.items() if tag != 'time' and col in header]
+        cols = [header.index(inputs.historian_tags[tag]) for tag in tags]
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if len(lines) == 0:
+                break
+            times = np.loadtxt(lines, delimiter=',', usecols=time_col, dtype=str, ndmin=1)
+            try:
+                values = np.loadtxt(lines, delimiter=',', usecols=cols, dtype=float, ndmin=2)
+            except ValueError:  # slow path for chunks with blanks
+                values = np.genfromtxt(lines, delimiter=',', usecols=cols, dtype=float, ndmin=2)
+            chunk = {'time': parse_times(np.char.strip(times))}
+            for i, tag in enumerate(tags):
+                chunk[tag] = values[:, i]
+            yield chunk
+
+
+def forward_fill(a):
+    # fills NaNs along the last axis with last known value, leading NaNs stay
+    known = np.where(np.isfinite(a), np.arange(a.shape[-1]), 0)
+    np.maximum.accumulate(known, axis=-1, out=known)
+    return np.take_along_axis(a, known, axis=-1)
+
+
+def align(paths, timestamps, chunk_rows=inputs.historian_chunk_rows):
+    # streams historian exports onto the model's timestamps grid and converts them to model units
+    # amounts are averaged over each timestep, states are taken as last known values
+    # returns dict of arrays of length of timestamps, NaN where nothing is measured
+    dt = timestamps[1] - timestamps[0]
+    total = len(timestamps)
+    sums = {}
+    counts = {}
+    last = {}
+    for path in paths:
+        for chunk in read_chunks(path, chunk_rows):
+            step = np.rint((chunk.pop('time') - timestamps[0]) / dt).astype(np.int64)
+            on_grid = (step >= 0) & (step < total)
+            for tag, values in chunk.items():
+                ok = on_grid & np.isfinite(values)
+                if not np.any(ok):
+                    continue
+                if tag in discrete_tags:
+                    if tag not in last:
+                        last[tag] = np.full(total, np.nan)
+                    last[tag][step[ok]] = values[ok]  # rows are chronological, so last row of each timestep wins
+                else:
+                    if tag not in sums:
+                        sums[tag] = np.zeros(total, dtype=float)
+                        counts[tag] = np.zeros(total, dtype=float)
+                    # only touch the part of the grid covered by this chunk
+                    first = step[ok].min()
+                    binned_sums = np.bincount(step[ok] - first, weights=values[ok])
+                    binned_counts = np.bincount(step[ok] - first)
+                    sums[tag][first:first+len(binned_sums)] += binned_sums
+                    counts[tag][first:first+len(binned_counts)] += binned_counts
+    raw = {}
+    for tag in inputs.historian_tags:
+        if tag in sums:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                raw[tag] = sums[tag] / counts[tag]
+        elif tag in last:
+            raw[tag] = forward_fill(last[tag])
+        else:
+            raw[tag] = np.full(total, np.nan)
+    return to_model_units(raw)
+
+
+def to_model_units(raw):
+    # converts aligned historian tags to the model's quantities in SI units
+    measured = {}
+    measured['hp'] = inputs.V_hp_storage * thermophysical.d_from_p_t(raw['hp_psi'] * 6894.76, thermophysical.T_env)
+    measured['bag'] = raw['bag_cu_ft'] * 0.0283168 * inputs.d_bag
+    measured['dewar'] = raw['linde_dewar_L'] * 1e-3 * inputs.d_linde_dewar
+    measured['ucn'] = raw['ucn_L'] * 1e-3 * inputs.d_ucn_4K
+    measured['dewar_storage'] = np.array([raw[f'dewar_{d}_L'] for d in range(inputs.N_dewars)]) * \
+                                1e-3 * inputs.d_portable_dewar
+    measured['dewar_cmms'] = np.array([raw[f'dewar_{d}_cmms'] for d in range(inputs.N_dewars)])
+    for tag in ['linde_run', 'ucn_source', 'ucn_beam', 'ucn_transfer', 'dewar_fill']:
+        measured[tag] = raw[tag]
+    return measured
+
+
+def least_squares(columns, y):
+    # fits y = sum(coefficient * column) in least squares sense, returns NaNs if there is nothing to fit
+    # coefficients the data can't tell apart (e.g. linde always running, or never) are NaN too, rather than
+    # a minimum-norm split between them
+    if len(y) == 0:
+        return np.full(len(columns), np.nan)
+    a = np.column_stack(columns)
+    coefficients, _, rank, _ = np.linalg.lstsq(a, y, rcond=None)
+    if rank < a.shape[1]:
+        # coefficient is identified only if its unit vector lies within the row space of the columns
+        row_space = np.linalg.svd(a, full_matrices=False)[2][:rank]
+        coefficients[~np.isclose(np.sum(row_space**2, axis=0), 1.0)] = np.nan
+    return coefficients
+
+
+def time_since_start(flag, dt):
+    # returns time passed since flag last turned on at each step [s], inf if it never did
+    steps = np.arange(len(flag))
+    started = np.concatenate(([flag[0] == 1], (flag[1:] == 1) & (flag[:-1] != 1)))
+    last_start = np.maximum.accumulate(np.where(started, steps, -1))
+    return np.where(last_start >= 0, (steps - last_start) * dt, np.inf)
+
+
+def calibrate(measured, timestamps):
+    # fits loss and rate constants of inputs.py to measured inventories
+    # only timesteps during which all relevant states hold are used, so fills, swaps and startups are excluded
+    dt = timestamps[1] - timestamps[0]
+    run = measured['linde_run']
+    transfer = measured['ucn_transfer']
+    source = measured['ucn_source']
+    fill = measured['dewar_fill']
+    held = lambda a: a[..., 1:] == a[..., :-1]  # state didn't change during timestep, false for unknown states
+    all_held = held(run) & held(transfer) & held(source) & held(fill)
+    fitted = {}
+
+    # main dewar boil-off: linde is off and nothing is taken from the main dewar
+    d_dewar = np.diff(measured['dewar'])
+    idle = all_held & (run[1:] == 0) & (transfer[1:] == 0) & (source[1:] == 0) & (fill[1:] == -1) & \
+           np.isfinite(d_dewar)
+    m_dewar_loss = least_squares([np.full(np.count_nonzero(idle), dt)], -d_dewar[idle])[0]
+    fitted['x_linde_dewar_loss_day'] = m_dewar_loss * 24 * 3600 / inputs.M_linde_dewar_max
+
+    # reduction of production during ucn transfers: linde is fully ramped up and only ucn is filled
+    ucn_transfer = inputs.m_transfer_line + inputs.m_vapor_ucn_4K_Q + inputs.x_vapor_ucn_4K_JT * inputs.m_transfer_line
+    ramped_up = time_since_start(run, dt)[1:] >= inputs.t_rampup_linde_warm
+    cooled_down = time_since_start(source, dt)[1:] >= inputs.t_ucn_cooldown
+    transferring = all_held & (run[1:] == 1) & (transfer[1:] == 1) & (fill[1:] == -1) & ramped_up & cooled_down & \
+                   np.isfinite(d_dewar)
+    y = d_dewar[transferring] - (inputs.m_linde_dewar - ucn_transfer) * dt
+    fitted['x_linde_production_transfer'] = least_squares([np.full(len(y), -inputs.m_linde_dewar * dt)], y)[0]
+
+    # losses of running linde: total inventory drops faster when linde runs
+    # bag venting and experiments fed by dewars not in the historian (i.e. purchased ones) are excluded
+    inventory = measured['hp'] + measured['bag'] + measured['dewar'] + measured['ucn'] + \
+                np.sum(measured['dewar_storage'], axis=0)
+    d_inventory = np.diff(inventory)
+    scheduled = np.zeros((len(inputs.cmms_consumption), len(timestamps)), dtype=bool)
+    for c in range(len(inputs.cmms_consumption)):
+        for s in inputs.schedule[c]:
+            scheduled[c] |= (s[0] <= timestamps) & (timestamps <= s[1])
+    experiments = np.arange(len(inputs.cmms_consumption))[:, None, None]
+    fed = np.any(measured['dewar_cmms'][None, :, :] == experiments, axis=1)
+    unmeasured_feed = np.any(scheduled & ~fed, axis=0)
+    closed = all_held & (measured['bag'][1:] < inputs.M_bag_max * 0.99) & ~unmeasured_feed[1:] & \
+             ~unmeasured_feed[:-1] & np.isfinite(d_inventory)
+    m_linde_loss = least_squares([run[1:][closed] * dt, np.full(np.count_nonzero(closed), dt)], -d_inventory[closed])[0]
+    fitted['m_linde_loss_g_s'] = m_linde_loss * 1e3
+
+    # portable dewars: boil-off on the wall and draw of each cmms experiment
+    dewars = np.arange(inputs.N_dewars)[:, None]
+    d_dewars = np.diff(measured['dewar_storage'], axis=1)
+    cmms = measured['dewar_cmms']
+    cold = (measured['dewar_storage'][:, 1:] > 0) & (measured['dewar_storage'][:, :-1] > 0) & np.isfinite(d_dewars)
+    stored = cold & held(cmms) & (cmms[:, 1:] == -1) & held(fill) & (fill[1:] != dewars)
+    m_portable_dewar_loss = least_squares([np.full(np.count_nonzero(stored), dt)], -d_dewars[stored])[0]
+    fitted['x_portable_dewar_loss_day'] = m_portable_dewar_loss * 24 * 3600 / inputs.M_portable_dewar_full
+    # one single-parameter least squares per experiment, all solved at once
+    attached = cold & held(cmms) & (cmms[:, 1:] >= 0) & (cmms[:, 1:] < len(inputs.cmms_consumption))
+    experiment = cmms[:, 1:][attached].astype(int)
+    drawn = np.bincount(experiment, weights=-d_dewars[attached], minlength=len(inputs.cmms_consumption))
+    samples = np.bincount(experiment, minlength=len(inputs.cmms_consumption))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fitted['cmms_consumption'] = np.where(samples > 0, drawn / (samples * dt), np.nan)
+    return fitted
+
+
+def replay_states(measured):
+    # returns measured linde and ucn states to drive the model with: 1 - on, 0 - off, -1 - unknown
+    replay = {}
+    for tag in ['linde_run', 'ucn_source', 'ucn_beam']:
+        replay[tag] = np.where(np.isfinite(measured[tag]), measured[tag] != 0, -1).astype(np.int8)
+    return replay
+
+
+def residuals(measured, modelled):
+    # compares modelled amounts to measured ones wherever measured, prints and returns rms and max errors [kg]
+    out = {}
+    for k in modelled:
+        error = (modelled[k] - measured[k])[np.isfinite(measured[k])]
+        if len(error) == 0:
+            continue
+        out[k] = (np.sqrt(np.mean(error**2)), np.max(np.abs(error)))
+        print(f'replay residual of {k}: rms {out[k][0]:.3f} kg, max {out[k][1]:.3f} kg')
+    return out
+
+
+if __name__ == "__main__":
+    # calibrates constants against historian exports covering inputs.start_time to inputs.end_time
+    # usage: python historian.py export1.csv export2.csv ...
+    timestamps = np.arange(inputs.start_time, inputs.end_time, inputs.timestep)
+    fitted = calibrate(align(sys.argv[1:], timestamps), timestamps)
+    for k, v in fitted.items():
+        print(f'{k}: fitted {v}, inputs.py {getattr(inputs, k)}')
@@ -21,6 +21,7 @@ V_linde_dewar_min_safe_L = 100  # minimal safe level in the dewar (stop fills wh
 V_linde_dewar_min_okay_L = 110  # minimal level in the dewar at which fills can be started [L]
 V_linde_dewar_max_L = 900  # maximal level in the dewar [L]
 V_linde_dewar_start_L = 500  # threshold of dewar level for NOT starting linde if it's not running already [L]
+V_linde_dewar_trip_L = 1000  # level in the dewar at which linde trips even outside of operator time window [L]
 x_linde_dewar_loss_day = 0.5 / 100  # dewar liquid helium loss per day
 x_linde_production_transfer = 47.0 / 100  # max reduction of production at max withdrawal rate
 x_linde_dewar_fill_loss = 0.0 / 100  # losses when filling dewars as a fraction of what lands into dewar
@@ -35,6 +36,7 @@ M_linde_dewar_min_okay = V_linde_dewar_min_okay_L * 1e-3 * d_linde_dewar  # min
 M_linde_dewar_max = V_linde_dewar_max_L * 1e-3 * d_linde_dewar  # max amount in the dewar [kg]
 # M_linde_dewar_start: threshold of dewar level for NOT starting linde if it's not running [kg]
 M_linde_dewar_start = V_linde_dewar_start_L * 1e-3 * d_linde_dewar
+M_linde_dewar_trip = V_linde_dewar_trip_L * 1e-3 * d_linde_dewar  # level at which linde trips [kg]
 m_linde_dewar_loss = M_linde_dewar_max * x_linde_dewar_loss_day / 24 / 3600  # dewar evap rate [kg/s]
 m_dewar_pull_run = v_dewar_pull_run_L_hr * 1e-3 * d_linde_dewar / 3600  # max dewar fill flow rate [L/hr]
 m_dewar_pull_off = v_dewar_pull_off_L_hr * 1e-3 * d_linde_dewar / 3600  # dewar fill flow rate [L/hr]
@@ -45,24 +47,35 @@ m_linde_loss = m_linde_loss_g_s * 1e-3  # rate of helium loss when liquefier is
 # hp & lp storage data
 p_hp_storage_max_psi = 3600  # max allowed pressure in hp storage [psi]
 p_hp_storage_min_psi = 500  # min allowed pressure in hp storage [psi]
-m_hp_compressor = 4.08e-3 / 3  # total flow of recovery compressors per each compressor [kg/s]
+p_hp_storage_trip_psi = 300  # pressure in hp storage at which linde trips even outside of operator time window [psi]
 V_hp_storage_cu_ft = 45.9 * 9  # total volume of impure hp storage [ft^3]
 V_bag_max_cu_ft = 1500  # max volume of the bag [ft^3]
-x_bag_setpoint_high_1 = 0.70  # high setpoint of bag volume for hp compressor 1
-x_bag_setpoint_high_2 = 0.75  # high setpoint of bag volume for hp compressor 2
-x_bag_setpoint_high_3 = 0.80  # high setpoint of bag volume for hp compressor 3
-x_bag_setpoint_low_1 = 0.25  # low setpoint of bag volume for hp compressor 1
-x_bag_setpoint_low_2 = 0.30  # low setpoint of bag volume for hp compressor 2
-x_bag_setpoint_low_3 = 0.35  # low setpoint of bag volume for hp compressor 3
+# hp compressor bank: one entry per compressor, compressors are loaded in the order they're listed
+m_hp_compressors = np.array([4.08e-3 / 3,  # flow of each recovery compressor [kg/s]
+                             4.08e-3 / 3,
+                             4.08e-3 / 3])
+x_bag_setpoints_high = np.array([0.70,  # high setpoint of bag volume for each hp compressor
+                                 0.75,
+                                 0.80])
+x_bag_setpoints_low = np.array([0.25,  # low setpoint of bag volume for each hp compressor
+                                0.30,
+                                0.35])
 # hp & lp storage calcs
 p_hp_storage_max = p_hp_storage_max_psi * 6894.76  # max allowed pressure in hp storage [Pa]
 p_hp_storage_min = p_hp_storage_min_psi * 6894.76  # min allowed pressure in hp storage [Pa]
+p_hp_storage_trip = p_hp_storage_trip_psi * 6894.76  # pressure in hp storage at which linde trips [Pa]
 V_hp_storage = V_hp_storage_cu_ft * 0.0283168  # total volume of impure hp storage [m^3]
 V_bag_max = V_bag_max_cu_ft * 0.0283168  # max volume of the bag [m^3]
 M_hp_storage_max = V_hp_storage * d_from_p_t(p_hp_storage_max, T_env)  # max amount of gas in hp storage [kg]
 M_hp_storage_min = V_hp_storage * d_from_p_t(p_hp_storage_min, T_env)  # min amount of gas in hp storage [kg]
+M_hp_storage_trip = V_hp_storage * d_from_p_t(p_hp_storage_trip, T_env)  # amount of gas at which linde trips [kg]
 d_bag = d_from_p_t(p_atm, T_env)  # density of helium in helium bag [kg/m^3]
 M_bag_max = V_bag_max * d_bag  # max amount of gas in the bag [kg]
+N_hp_compressors = len(m_hp_compressors)  # total number of hp compressors
+M_bag_setpoints_high = M_bag_max * x_bag_setpoints_high  # high setpoint of bag inventory for each hp compressor [kg]
+M_bag_setpoints_low = M_bag_max * x_bag_setpoints_low  # low setpoint of bag inventory for each hp compressor [kg]
+assert len(x_bag_setpoints_high) == len(x_bag_setpoints_low) == N_hp_compressors
+assert np.all(x_bag_setpoints_low < x_bag_setpoints_high)
 
 # portable dewars data
 N_dewars_purchased_max = 100  # max number of dewars to be purchased
@@ -124,6 +137,12 @@ timestep = 60  # timestep for iteration [s]
 start_time = parse_time('2027-04-01 00:00:00')  # starting time in YYYY-MM-DD HH:MM:SS format
 end_time = parse_time('2027-12-31 23:59:59')  # end time in YYYY-MM-DD HH:MM:SS format
 prediction_window = 5 * 24 * 3600  # period for predicting future use and making operational decisions [s]
+# liquefier scheduling: linde is started and stopped by operators only at decision points within the time window
+linde_window = None  # local hours within which linde can be started or stopped, e.g. (6, 18), None for any time
+t_linde_decision = 1 * 3600  # interval between decision points within the time window [s]
+t_linde_lookahead = 18 * 3600  # period simulated ahead to compare starting and stopping linde [s]
+fast_mode = False  # skip per-step sanity checks and rely on vectorized audit of the history after each chunk
+M_mass_balance_tolerance = 1e-9  # max change of helium inventory per step not considered a leak [kg]
 
 # schedule tuples: [(start, stop), (start, stop), ... ]
 # dewar 1 is 0, dewar 2 is 1, etc.
@@ -162,3 +181,46 @@ cmms_consumption[8] = 330 * 1e-3 * d_portable_dewar / 7 / 24 / 3600
 cmms_consumption[9] = 33.3 * 1e-3 * d_portable_dewar / 7 / 24 / 3600
 cmms_consumption[10] = 330 * 1e-3 * d_portable_dewar / 7 / 24 / 3600
 cmms_consumption[11] = 165 * 1e-3 * d_portable_dewar / 7 / 24 / 3600
+# consumption profiles: cmms_consumption holds unless the profile of an experiment says otherwise
+# applied in order: series, weekend multiplier, cooldown surge multiplier, segments
+# series: (times, consumption [kg/s]) - each consumption holds from its time until the next one, e.g. from a log
+cmms_consumption_series = {}
+# weekend: multiplier of consumption on saturdays and sundays (local time)
+cmms_consumption_weekend = {}
+# cooldown surge: (period [s], multiplier) - consumption is multiplied during period after each scheduled start
+cmms_consumption_surge = {}
+# segments: [(start, stop, consumption [kg/s]), ...] - consumption within segment, later segments override earlier
+cmms_consumption_segments = {}
+# e.g. magnet of experiment 0 ramped up for two days at triple consumption:
+# cmms_consumption_segments[0] = [(parse_time('2027-05-03 08:00:00'), parse_time('2027-05-05 08:00:00'),
+#                                  3 * cmms_consumption[0])]
+
+# plant historian data
+# historian_tags: names of columns in historian csv exports for each measured quantity
+historian_tags = {
+    'time': 'timestamp',  # unix epoch [s] or local time in YYYY-MM-DD HH:MM:SS format
+    'linde_dewar_L': 'LINDE_DEWAR_LEVEL',  # level in main dewar [L]
+    'bag_cu_ft': 'BAG_VOLUME',  # volume of gas in the bag [ft^3]
+    'hp_psi': 'HP_STORAGE_PRESSURE',  # pressure in hp storage [psi]
+    'ucn_L': 'UCN_4K_LEVEL',  # level in ucn 4K pot [L]
+    'linde_run': 'LINDE_RUN',  # liquefier is running [0/1]
+    'ucn_source': 'UCN_SOURCE_ON',  # ucn source is running [0/1]
+    'ucn_beam': 'UCN_BEAM_ON',  # beam is delivered to ucn source [0/1]
+    'ucn_transfer': 'UCN_TRANSFER',  # main dewar is filling ucn cryostat [0/1]
+    'dewar_fill': 'DEWAR_FILL',  # dewar being filled from main dewar, dewar 1 is 0, dewar 2 is 1, etc. [-1 if none]
+}
+for d in range(N_dewars):
+    historian_tags[f'dewar_{d}_L'] = f'DEWAR_{d + 1}_LEVEL'  # level in portable dewar [L]
+    historian_tags[f'dewar_{d}_cmms'] = f'DEWAR_{d + 1}_CMMS'  # experiment fed by portable dewar [-1 if none]
+historian_chunk_rows = 100000  # number of csv rows read at once, limits memory used by historian ingestion
+historian_replay_files = []  # historian csv exports driving linde and ucn states, empty list to run the model as is
+
+# live forecast data
+t_forecast = 3 * 24 * 3600  # period forecasted from current plant state [s]
+t_forecast_refresh = 5 * 60  # how often current plant state is checked for updates [s]
+forecast_state_file = 'state.json'  # current plant state, keys are the same as historian_tags
+forecast_alerts_file = 'alerts.json'  # alerts published by the forecast
+
+# results archive
+archive_file = 'results.npz'  # compressed histories, state tables and inputs of the run, re-plotted by replot.py
+t_archive_chunk = 7 * 24 * 3600  # histories are archived in chunks of this period, re-plots only read chunks they need [s]
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
 import hashlib
+import json
 import sys
 import time
+import types
+from datetime import datetime
 import numpy as np
 import matplotlib.pyplot as plt
 import thermophysical
 import inputs
-from ctypes import c_int32  # little hack to create a "mutable integer"
+import historian
+from ctypes import c_int32, c_bool  # little hack to create a "mutable integer" and a "mutable boolean"
 
 # create data array storing system's state and its history
+# module globals hold the state of the run driven by this module, simulation.Simulation swaps in its own instead,
+# so anything added to the state here needs to be added to simulation.new_state too
 dt = inputs.timestep
 total_steps = int((inputs.end_time - inputs.start_time) / dt) + 1
 dewars_list = range(inputs.N_dewars)
@@ -21,119 +27,269 @@ charts = {}
 
 timestamps = np.arange(inputs.start_time, inputs.end_time, dt)
 timestamps_days = np.arange(0, (inputs.end_time-inputs.start_time)/24/3600, dt/24/3600)
+# schedules laid over timestamps once, so lurking through them is a lookup
+schedule_on = {}
+for thing, thing_schedule in inputs.schedule.items():
+    schedule_on[thing] = np.zeros(len(timestamps), dtype=bool)
+    for period in thing_schedule:
+        schedule_on[thing] |= (period[0] <= timestamps) & (timestamps <= period[1])
+cmms_on = np.array([schedule_on[c] for c in cmms_list])  # same for all cmms experiments at once
+# local time of day [s], utc offset only changes on the hour so it's only looked up once per hour
+timestamps_hours, hour_index = np.unique(timestamps // 3600 * 3600, return_inverse=True)
+utc_offsets = np.array([datetime.fromtimestamp(t, inputs.triumf_tz).utcoffset().total_seconds() for t in timestamps_hours])
+time_of_day = (timestamps + utc_offsets[hour_index]) % (24 * 3600)
+weekend = np.isin((timestamps + utc_offsets[hour_index]) // (24 * 3600) % 7, (2, 3))  # unix epoch was a thursday
+# consumption of cmms experiments laid over timestamps once [kg/s], see consumption profiles in inputs.py
+cmms_rate = np.repeat(inputs.cmms_consumption[:, None], len(timestamps), axis=1)
+for c, (times, consumption) in inputs.cmms_consumption_series.items():
+    since = np.searchsorted(times, timestamps, side='right') - 1
+    cmms_rate[c] = np.where(since >= 0, np.asarray(consumption)[np.maximum(since, 0)], cmms_rate[c])
+for c, multiplier in inputs.cmms_consumption_weekend.items():
+    cmms_rate[c][weekend] *= multiplier
+for c, (period, multiplier) in inputs.cmms_consumption_surge.items():
+    for start, _ in inputs.schedule[c]:
+        cmms_rate[c][(start <= timestamps) & (timestamps < start + period)] *= multiplier
+for c, segments in inputs.cmms_consumption_segments.items():
+    for start, stop, consumption in segments:
+        cmms_rate[c][(start <= timestamps) & (timestamps <= stop)] = consumption
+# cumulative consumption [kg]: cmms_drawn[c][step] is what experiment c draws up to step (included) when running
+# so draw over a period is a difference and the step by which it draws a given amount is a searchsorted
+cmms_drawn = np.cumsum(cmms_rate * dt, axis=1)
 
 linde_storage = np.zeros(total_steps,
     dtype={'names': ['hp',  'bag', 'dewar', 'ucn', 'loss'],
          'formats': [float, float, float,   float, float]}
 )
-linde_state = np.zeros(total_steps,
-    dtype={'names': ['run', 'warmup', 'hp_comp_1', 'hp_comp_2', 'hp_comp_3', 'transfer', 'transfer_trickle', 'filling'],
-         'formats': [bool,  bool,     bool,        bool,        bool,        bool,       bool,               bool]}
+# linde and ucn states are bit-packed flags, one bit per state, see linde_on, set_linde, linde_history, etc.
+linde_flags = {'run': np.uint8(1), 'warmup': np.uint8(2), 'transfer': np.uint8(4), 'transfer_trickle': np.uint8(8),
+               'filling': np.uint8(16)}
+linde_state = np.zeros(total_steps, dtype=np.uint8)
+# helium created at each step by levels clamped at zero instead of going negative [kg]: ucn cryostat running dry
+# during cooldown and warm dewars reset to empty, see op_ucn and op_dewars
+clamped = np.zeros(total_steps,
+    dtype={'names': ['ucn', 'dewars'],
+         'formats': [float, float]}
 )
 linde_production = np.zeros(total_steps, dtype=float)
 linde_state_logbook = {}
 
+# hp compressor bank: one row per compressor, True when compressor is running
+hp_comp_state = np.zeros((inputs.N_hp_compressors, total_steps), dtype=bool)
+hp_comp_run_time = np.zeros(inputs.N_hp_compressors, dtype=float)  # total run time of each compressor [s]
+hp_comp_starts = np.zeros(inputs.N_hp_compressors, dtype=int)  # total number of starts of each compressor
+
 dewar_storage = np.zeros((inputs.N_dewars, total_steps), dtype=float)
 dewar_cooldown = np.zeros(inputs.N_dewars, dtype=float)
-dewar_state = np.zeros((inputs.N_dewars, total_steps),
-    dtype={'names': ['warm', 'store', 'low', 'fill', 'cmms'],
-         'formats': [bool,   bool,    bool,  bool,   bool]}
-)
+# each dewar is always in exactly one state, which is stored as a code
+dewar_states = {'warm': np.uint8(0), 'store': np.uint8(1), 'low': np.uint8(2), 'fill': np.uint8(3), 'cmms': np.uint8(4)}
+dewar_state_names = {code: name for name, code in dewar_states.items()}
+dewar_state = np.zeros((inputs.N_dewars, total_steps), dtype=np.uint8)
 dewar_state_logbook = {}
 
 purchased_dewar_storage = np.zeros((inputs.N_dewars_purchased_max, total_steps), dtype=float)
+purchased_dewar_step = np.full(inputs.N_dewars_purchased_max, -1, dtype=int)  # step at which each dewar was purchased
 purchased_dewar_state_logbook = {}
 
 # cmms_states indicates if cmms is off (-1) or number of the dewar feeding it minus one
-# numbers higher then 100 indicate a purchased dewar, e.g. 100 - first purchased dewar. 101 - second purchased dewar
-cmms_state = np.zeros((total_cmms, total_steps), dtype=int)
+# numbers starting from purchased_dewar_offset indicate a purchased dewar, e.g. 100 - first purchased dewar,
+# 101 - second purchased dewar; offset is the next power of ten past triumf dewar numbers, but at least 100
+purchased_dewar_offset = 10 ** max(2, len(str(inputs.N_dewars)))
+cmms_state = np.zeros((total_cmms, total_steps), dtype=np.int16)
+assert purchased_dewar_offset + inputs.N_dewars_purchased_max <= np.iinfo(cmms_state.dtype).max
 cmms_state_logbook = []
 
-ucn_state = np.zeros(total_steps,
-    dtype={'names': ['static', 'beam', 'cooldown'],
-         'formats': [bool,     bool,   bool]})
+ucn_flags = {'static': np.uint8(1), 'beam': np.uint8(2), 'cooldown': np.uint8(4)}
+ucn_state = np.zeros(total_steps, dtype=np.uint8)
 ucn_state_logbook = {}
 
+# measured linde and ucn states replayed instead of modelled ones, see historian.replay_states
+replay = {}
+
+# linde scheduling: decision points are spread within operator time window, see schedule_linde
+# each decision point is the first step at or after a multiple of t_linde_decision, so steps don't need to land on it
+assert inputs.t_linde_decision >= dt
+if inputs.linde_window is None:
+    linde_decision_step = np.ones(total_steps, dtype=bool)
+else:
+    linde_window_open = (inputs.linde_window[0] * 3600 <= time_of_day) & (time_of_day <= inputs.linde_window[1] * 3600)
+    linde_decision_step = linde_window_open & (time_of_day % inputs.t_linde_decision < dt)
+    # world of initialize() has no operator decision to hold, so the run starts with one wherever it starts
+    linde_decision_step[1] = True
+linde_decision_steps = np.flatnonzero(linde_decision_step)
+# last decision point of each window, after which linde state is held until the next window opens
+linde_last_decision_step = np.zeros(total_steps, dtype=bool)
+linde_last_decision_step[linde_decision_steps[np.diff(timestamps[linde_decision_steps], append=np.inf) >
+                                              inputs.t_linde_decision + dt]] = True
+linde_plan = {}  # linde run decisions made by look-ahead at decision points, step: run
+lookahead_active = c_bool(False)  # true while the future is simulated by look-ahead
+lookahead_log = []  # messages logged while the future is simulated, printed if that future is kept
+linde_held = c_bool(False)  # set when linde state is held against the thresholds, see schedule_linde
+simulated_ahead = c_int32(0)  # steps before this one were already simulated by look-ahead, see plan_linde
+verbose = c_bool(True)  # print state changes
+
+
+class IterationStopped(Exception):
+    # raised when iteration can't go on, step is the one that couldn't be simulated
+    def __init__(self, step, msg):
+        super().__init__(msg)
+        self.step = step
+
+
+class InconsistentState(IterationStopped):
+    # raised when states contradict each other, e.g. linde is filling a dewar that isn't being filled
+    pass
+
+
+class PurchaseLimitReached(IterationStopped):
+    # raised when max number of dewars to purchase is exceeded
+    pass
+
+
+class PeriodEnded(IterationStopped):
+    # raised when asked to simulate past the end of modelled period
+    pass
+
+
+def log(msg):
+    # prints log messages, messages of simulated future are kept aside instead
+    if verbose.value:
+        if lookahead_active.value:
+            lookahead_log.append(msg)
+        else:
+            print(msg)
+
+
+def linde_on(flag, step):
+    # tells if linde is in the state specified by flag at step
+    return bool(linde_state[step] & linde_flags[flag])
+
+
+def set_linde(flag, step, value):
+    # sets or clears linde state specified by flag at step
+    if value:
+        linde_state[step] |= linde_flags[flag]
+    else:
+        linde_state[step] &= ~linde_flags[flag]
+
+
+def linde_history(flag, step_from=0, step_to=total_steps):
+    # returns boolean history of linde state specified by flag
+    return (linde_state[step_from:step_to] & linde_flags[flag]) != 0
+
+
+def ucn_on(flag, step):
+    # tells if ucn is in the state specified by flag at step
+    return bool(ucn_state[step] & ucn_flags[flag])
+
+
+def set_ucn(flag, step, value):
+    # sets or clears ucn state specified by flag at step
+    if value:
+        ucn_state[step] |= ucn_flags[flag]
+    else:
+        ucn_state[step] &= ~ucn_flags[flag]
+
+
+def ucn_history(flag, step_from=0, step_to=total_steps):
+    # returns boolean history of ucn state specified by flag
+    return (ucn_state[step_from:step_to] & ucn_flags[flag]) != 0
+
 
 def change_dewar_state(dewar, new_state, step):
     # changes the state of specified dewar and marks it as "low" if it's below the threshold level
-    if dewar < 100:
-        for ds in dewar_state.dtype.names:
-            dewar_state[ds][dewar][step] = False
+    if dewar < purchased_dewar_offset:
         if new_state == 'store' and dewar_storage[dewar][step] < inputs.M_portable_dewar_topup:
             new_state = 'low'
         # when dewar becomes "warm", amount of LHe required for cooldown is set
         if new_state == 'warm':
             dewar_cooldown[dewar] = -inputs.M_portable_dewar_cooldown
-        dewar_state[new_state][dewar][step] = True
+        dewar_state[dewar][step] = dewar_states[new_state]
+
+
+def dewar_being_filled(step):
+    # returns dewar being filled from main dewar at step, -1 if none
+    filling = np.nonzero(dewar_state[:, step] == dewar_states['fill'])[0]
+    return filling[0] if len(filling) > 0 else -1
 
 
 def log_linde_state(step):
     # logs which linde states changed and when
-    for s in linde_state.dtype.names:
-        if linde_state[s][step] and not linde_state[s][step-1]:
+    if linde_state[step] == linde_state[step-1]:
+        return
+    for s in linde_flags:
+        if linde_on(s, step) and not linde_on(s, step-1):
             linde_state_logbook[f'{s}_1'] = step
-            print(f'linde state change: "{s}" from 0 to 1')
-        elif not linde_state[s][step] and linde_state[s][step-1]:
+            log(f'linde state change: "{s}" from 0 to 1')
+        elif not linde_on(s, step) and linde_on(s, step-1):
             linde_state_logbook[f'{s}_0'] = step
-            print(f'linde state change: "{s}" from 1 to 0')
+            log(f'linde state change: "{s}" from 1 to 0')
+
+
+def log_hp_comp_state(step):
+    # logs which hp compressors started or stopped and when, and counts their starts for maintenance planning
+    started = hp_comp_state[:, step] & ~hp_comp_state[:, step-1]
+    stopped = ~hp_comp_state[:, step] & hp_comp_state[:, step-1]
+    hp_comp_starts[started] += 1
+    for c in np.nonzero(started)[0]:
+        log(f'hp compressor {c} state change: from 0 to 1')
+    for c in np.nonzero(stopped)[0]:
+        log(f'hp compressor {c} state change: from 1 to 0')
 
 
 def log_dewar_state(step):
     # logs which dewar states changed and when
-    for d in dewars_list:
-        for s in dewar_state.dtype.names:
-            if dewar_state[s][d][step] and not dewar_state[s][d][step-1]:
-                dewar_state_logbook[f'{d}_{s}_1'] = step
-                print(f'dewar {d} state change: "{s}" from 0 to 1')
-            elif not dewar_state[s][d][step] and dewar_state[s][d][step-1]:
-                dewar_state_logbook[f'{d}_{s}_0'] = step
-                print(f'dewar {d} state change: "{s}" from 1 to 0')
+    for d in np.nonzero(dewar_state[:, step] != dewar_state[:, step-1])[0]:
+        state_from = dewar_state_names[dewar_state[d][step-1]]
+        state_to = dewar_state_names[dewar_state[d][step]]
+        dewar_state_logbook[f'{d}_{state_from}_0'] = step
+        dewar_state_logbook[f'{d}_{state_to}_1'] = step
+        log(f'dewar {d} state change: from "{state_from}" to "{state_to}"')
 
 
 def log_ucn_state(step):
     # logs which ucn states changed and when
-    for s in ucn_state.dtype.names:
-        if ucn_state[s][step] and not ucn_state[s][step-1]:
+    if ucn_state[step] == ucn_state[step-1]:
+        return
+    for s in ucn_flags:
+        if ucn_on(s, step) and not ucn_on(s, step-1):
             ucn_state_logbook[f'{s}_1'] = step
-            print(f'ucn state change: "{s}" from 0 to 1')
-        elif not ucn_state[s][step] and ucn_state[s][step-1]:
+            log(f'ucn state change: "{s}" from 0 to 1')
+        elif not ucn_on(s, step) and ucn_on(s, step-1):
             ucn_state_logbook[f'{s}_0'] = step
-            print(f'ucn state change: "{s}" from 1 to 0')
+            log(f'ucn state change: "{s}" from 1 to 0')
 
 
 def log_cmms_state(step):
     # logs which cmms states changed and when
-    for c in cmms_list:
-        if cmms_state[c][step] != cmms_state[c][step-1]:
-            state_from = cmms_state[c][step-1]
-            state_to = cmms_state[c][step]
-            cmms_state_logbook.append((state_from, state_to, step))
-            if state_from == -1:
-                state_from = '"no dewar"'
-            if state_to == -1:
-                state_to = '"no dewar"'
-            print(f'cmms {c} state change: from dewar {state_from} to dewar {state_to}')
+    for c in np.nonzero(cmms_state[:, step] != cmms_state[:, step-1])[0]:
+        state_from = cmms_state[c][step-1]
+        state_to = cmms_state[c][step]
+        cmms_state_logbook.append((state_from, state_to, step))
+        if state_from == -1:
+            state_from = '"no dewar"'
+        if state_to == -1:
+            state_to = '"no dewar"'
+        log(f'cmms {c} state change: from dewar {state_from} to dewar {state_to}')
 
 
 def calc_dewar_fill(step, d):
     # returns amount landed into the portable dewar and losses to the bag considering dewar's warm/cold state
-    if not dewar_state['fill'][d][step]:
+    if dewar_state[d][step] != dewar_states['fill']:
         quit_iteration(step, 'dewar thinks it is being filled while linde disagrees')
     # define how much can be pulled from main dewar
-    if linde_state['run'][step]:
+    if linde_on('run', step):
         max_pull_from_dewar = inputs.m_dewar_pull_run
     else:
         max_pull_from_dewar = inputs.m_dewar_pull_off
     # if filling UCN then transfer to dewar is reduced
-    if linde_state['transfer'][step]:
+    if linde_on('transfer', step):
         transfer_to_dewar = max_pull_from_dewar - inputs.m_transfer_line
     else:
         transfer_to_dewar = max_pull_from_dewar
     losses_to_bag = inputs.x_linde_dewar_fill_loss * transfer_to_dewar
     # if cooldown amount wasn't delivered, dewar is still "warm"
     if dewar_cooldown[d] < 0:
-        print(d, dewar_cooldown[d])
+        log(f'dewar {d} cooldown: {dewar_cooldown[d]}')
         dewar_cooldown[d] += transfer_to_dewar * dt
         return 0, transfer_to_dewar + losses_to_bag
     else:
@@ -142,7 +298,7 @@ def calc_dewar_fill(step, d):
 
 def calc_linde_production(step):
     # calculates linde production considering both initial ramp up and reduced production during transfers
-    assert linde_state['run'][step]  # make sure linde is running
+    assert linde_on('run', step)  # make sure linde is running
     t_rampup = inputs.t_rampup_linde_cold
     if 'run_0' not in linde_state_logbook:     # if never stopped before then running first time (wow logic!)
         t_rampup = inputs.t_rampup_linde_warm  # i.e. cooling down from warm state
@@ -154,9 +310,9 @@ def calc_linde_production(step):
     ramp_mult = min(since_start / t_rampup, 1.0)
     # adjust production during transfers
     transfer_mult = 1.0
-    if linde_state['filling'][step]:
+    if linde_on('filling', step):
         transfer_mult = 1.0 - inputs.x_linde_production_transfer / inputs.m_dewar_pull_run * inputs.m_transfer_line
-    if linde_state['transfer'][step]:
+    if linde_on('transfer', step):
         transfer_mult = 1.0 - inputs.x_linde_production_transfer
     # convert from kg/s back to L/hr for the chart
     linde_production[step] = inputs.m_linde_dewar * ramp_mult * transfer_mult / 1e-3 * 3600 / inputs.d_linde_dewar
@@ -165,7 +321,7 @@ def calc_linde_production(step):
 
 def op_linde(step):
     # liquefaction
-    if linde_state['run'][step]:
+    if linde_on('run', step):
         production = calc_linde_production(step)
         linde_storage['hp'][step] -= (production + inputs.m_linde_loss) * dt
         linde_storage['dewar'][step] += production * dt
@@ -176,12 +332,8 @@ def op_linde(step):
         linde_storage['dewar'][step] -= dewar_loss
         linde_storage['bag'][step] += dewar_loss
     # filling portable dewar
-    if linde_state['filling'][step]:
-        filling_dewar_num = -1
-        for d in dewars_list:
-            if dewar_state['fill'][d][step]:
-                filling_dewar_num = d
-                break
+    if linde_on('filling', step):
+        filling_dewar_num = dewar_being_filled(step)
         if filling_dewar_num == -1:
             quit_iteration(step, 'linde thinks it is filling the dewar but all dewars disagree')
         to_portable_dewar, to_bag = calc_dewar_fill(step, filling_dewar_num)
@@ -189,9 +341,9 @@ def op_linde(step):
         linde_storage['bag'][step] += to_bag * dt
         linde_storage['dewar'][step] -= (to_portable_dewar + to_bag) * dt
     # filling ucn cryostat
-    if linde_state['transfer'][step]:
+    if linde_on('transfer', step):
         # during cooldown, fill with max flow
-        if ucn_state['cooldown'][step]:
+        if ucn_on('cooldown', step):
             ucn_transfer = inputs.m_dewar_pull_run
         else:
             ucn_transfer = inputs.m_transfer_line
@@ -199,7 +351,7 @@ def op_linde(step):
         linde_storage['dewar'][step] -= (ucn_transfer + ucn_transfer_loss) * dt
         linde_storage['bag'][step] += ucn_transfer_loss * dt
         linde_storage['ucn'][step] += ucn_transfer * dt
-    if linde_state['transfer_trickle'][step]:
+    if linde_on('transfer_trickle', step):
         # check if static load flow is enough to keep transfer line cold
         extra_flow = max(inputs.m_transfer_line_trickle - inputs.m_ucn_static, 0)
         linde_storage['dewar'][step] -= extra_flow * dt
@@ -212,69 +364,63 @@ def op_linde(step):
 
 def op_hp_compressors(step):
     # compression from bag to hp
-    hp_throughput = inputs.m_hp_compressor * dt
-    hp_transfer = min(linde_storage['bag'][step], hp_throughput)  # can't transfer more than left in the bag
-    if linde_state['hp_comp_1'][step]:
-        linde_storage['bag'][step] -= hp_transfer
-        linde_storage['hp'][step] += hp_transfer
-    hp_transfer = min(linde_storage['bag'][step], hp_throughput)
-    if linde_state['hp_comp_2'][step]:
-        linde_storage['bag'][step] -= hp_transfer
-        linde_storage['hp'][step] += hp_transfer
-    hp_transfer = min(linde_storage['bag'][step], hp_throughput)
-    if linde_state['hp_comp_3'][step]:
-        linde_storage['bag'][step] -= hp_transfer
-        linde_storage['hp'][step] += hp_transfer
+    # compressors take their share of the bag in order, so the ones listed last get whatever is left over
+    hp_throughput = inputs.m_hp_compressors * dt * hp_comp_state[:, step]
+    hp_taken_before = np.cumsum(hp_throughput) - hp_throughput
+    hp_transfer = np.clip(linde_storage['bag'][step] - hp_taken_before, 0, hp_throughput)  # can't take more than left
+    linde_storage['bag'][step] -= hp_transfer.sum()
+    linde_storage['hp'][step] += hp_transfer.sum()
+    hp_comp_run_time[:] += dt * hp_comp_state[:, step]
 
 
 def op_ucn(step):
     # evaporation from heat loads
-    if ucn_state['cooldown'][step]:
+    clamped['ucn'][step] = 0.0
+    if ucn_on('cooldown', step):
         ucn_flow = inputs.m_ucn_cooldown * dt
         linde_storage['ucn'][step] -= ucn_flow
         if linde_storage['ucn'][step] < 0:
+            clamped['ucn'][step] = -linde_storage['ucn'][step]
             linde_storage['ucn'][step] = 0
         linde_storage['bag'][step] += ucn_flow
-    if ucn_state['static'][step]:
+    if ucn_on('static', step):
         ucn_flow = inputs.m_ucn_static * dt
         linde_storage['ucn'][step] -= ucn_flow
         linde_storage['bag'][step] += ucn_flow
-    if ucn_state['beam'][step]:
+    if ucn_on('beam', step):
         ucn_flow = inputs.m_ucn_beam * dt
         linde_storage['ucn'][step] -= ucn_flow
         linde_storage['bag'][step] += ucn_flow
 
 
 def op_dewars(step):
-    for d in dewars_list:
-        # evaporation from dewars "on the wall"
-        if dewar_state[d][step]['store'] or dewar_state[d][step]['low']:
-            dewar_storage[d][step] -= inputs.m_portable_dewar_loss * dt
-            linde_storage['bag'][step] += inputs.m_portable_dewar_loss * dt
-        # dewars feeding cmms experiments are processed by op_cmms, including purchased ones
-        if dewar_state[d][step]['cmms']:
-            pass
-        # dewars being filled from main dewar are processed by op_linde
-        if dewar_state[d][step]['fill']:
-            pass
-        # warm dewars stay warm and very empty
-        if dewar_state[d][step]['warm']:
-            dewar_storage[d][step] = 0.0
+    # evaporation from dewars "on the wall", the whole fleet at once
+    # dewars feeding cmms experiments are processed by op_cmms, including purchased ones
+    # dewars being filled from main dewar are processed by op_linde
+    state = dewar_state[:, step]
+    storage = dewar_storage[:, step]  # view, so changes land in dewar_storage
+    on_the_wall = (state == dewar_states['store']) | (state == dewar_states['low'])
+    storage[on_the_wall] -= inputs.m_portable_dewar_loss * dt
+    linde_storage['bag'][step] += inputs.m_portable_dewar_loss * dt * np.count_nonzero(on_the_wall)
+    # warm dewars stay warm and very empty
+    warm = state == dewar_states['warm']
+    clamped['dewars'][step] = -np.sum(storage[warm])
+    storage[warm] = 0.0
 
 
 def op_cmms(step):
-    # evaporation from dewars feeding cmms, including purchased ones
-    for c in cmms_list:
-        cmms_dewar = cmms_state[c][step]
-        if cmms_dewar != -1:  # if cmms c is running during step
-            cmms_evap = inputs.cmms_consumption[c] * dt
-            linde_storage['bag'][step] += cmms_evap
-            # triumf dewars
-            if cmms_dewar < 100:
-                dewar_storage[cmms_dewar][step] -= cmms_evap
-            # purchased dewars
-            else:
-                purchased_dewar_storage[cmms_dewar-100][step] -= cmms_evap
+    # evaporation from dewars feeding cmms, including purchased ones, all experiments at once
+    # each dewar feeds one experiment at most, so dewar indices never repeat
+    cmms_dewar = cmms_state[:, step]
+    running = cmms_dewar != -1
+    cmms_evap = cmms_rate[running, step] * dt
+    dewars = cmms_dewar[running]
+    linde_storage['bag'][step] += cmms_evap.sum()
+    # triumf dewars
+    triumf = dewars < purchased_dewar_offset
+    dewar_storage[:, step][dewars[triumf]] -= cmms_evap[triumf]
+    # purchased dewars
+    purchased_dewar_storage[:, step][dewars[~triumf] - purchased_dewar_offset] -= cmms_evap[~triumf]
 
 
 def initialize():  # init the world
@@ -288,93 +434,87 @@ def initialize():  # init the world
     for cmms in cmms_list:
         cmms_state[cmms][0] = -1
     # set linde, dewars and ucn states (redundant since np.zeros does that so just to be explicit)
-    for s in linde_state.dtype.names:
-        linde_state[s][0] = False
+    linde_state[0] = 0
     # empty dewars and warm them up
     for d in dewars_list:
         dewar_storage[d][0] = 0
         change_dewar_state(d, 'warm', 0)
     # ucn states
-    for s in ucn_state.dtype.names:
-        ucn_state[s][0] = False
+    ucn_state[0] = 0
 
 
 def carry_amounts(step):
     # carry helium amounts from previous steps so they could be adjusted via -= and +=
-    for k in linde_storage.dtype.names:
-        linde_storage[k][step] = linde_storage[k][step-1]
-    for d in dewars_list:
-        dewar_storage[d][step] = dewar_storage[d][step-1]
-    for d in purchased_dewars_list:
-        purchased_dewar_storage[d][step] = purchased_dewar_storage[d][step-1]
+    linde_storage[step] = linde_storage[step-1]
+    dewar_storage[:, step] = dewar_storage[:, step-1]
+    purchased_dewar_storage[:, step] = purchased_dewar_storage[:, step-1]
 
 
 def carry_states(step):
     # carry states from previous steps
-    for d in dewars_list:
-        dewar_state[d][step] = dewar_state[d][step-1]
-    for cmms in cmms_list:
-        cmms_state[cmms][step] = cmms_state[cmms][step-1]
-    for k in linde_state.dtype.names:
-        linde_state[k][step] = linde_state[k][step-1]
+    dewar_state[:, step] = dewar_state[:, step-1]
+    cmms_state[:, step] = cmms_state[:, step-1]
+    linde_state[step] = linde_state[step-1]
 
 
 def is_this_thing_on(step, thing):
-    # lurks through the schedule and tells if the thing is on
-    t = timestamps[step]
-    for s in inputs.schedule[thing]:
-        if s[0] <= t <= s[1]:
-            return True
-    return False
+    # tells if the thing is on according to the schedule
+    return schedule_on[thing][step]
 
 
 # state setter function cannot use current state of the world - they suppose to set it
 # make sure to use only [step-1] for decision making in order to avoid cycling the logic
 def set_ucn_states(step):
-    ucn_state['static'][step] = is_this_thing_on(step, 'ucn_source')
-    ucn_state['beam'][step] = is_this_thing_on(step, 'ucn_beam')
-    if ucn_state['static'][step-1]:
+    set_ucn('static', step, is_this_thing_on(step, 'ucn_source'))
+    set_ucn('beam', step, is_this_thing_on(step, 'ucn_beam'))
+    # when replaying historian logs, measured states override the schedule
+    if replay and replay['ucn_source'][step] != -1:
+        set_ucn('static', step, replay['ucn_source'][step] == 1)
+    if replay and replay['ucn_beam'][step] != -1:
+        set_ucn('beam', step, replay['ucn_beam'][step] == 1)
+    if ucn_on('static', step-1):
         started = ucn_state_logbook['static_1']
         since_start = timestamps[step-1] - timestamps[started]
         if since_start < inputs.t_ucn_cooldown:  # if in cooldown mode
-            ucn_state['cooldown'][step] = True
+            set_ucn('cooldown', step, True)
         else:
-            ucn_state['cooldown'][step] = False
+            set_ucn('cooldown', step, False)
 
 
 def purchase_dewar(step):
     # adjusts total number of purchased dewars, "fills up" one purchased dewar and returns its number
     if dewars_purchased.value >= inputs.N_dewars_purchased_max:
-        quit_iteration(step, 'stop buying dewars already')
+        quit_iteration(step, 'stop buying dewars already', PurchaseLimitReached)
     purchased_dewar_storage[dewars_purchased.value][step] = inputs.M_portable_dewar_full
+    purchased_dewar_step[dewars_purchased.value] = step
     dewars_purchased.value += 1
-    return 100+dewars_purchased.value-1
+    return purchased_dewar_offset+dewars_purchased.value-1
+
+
+def return_dewars(dewars, step):
+    # places dewars detached from cmms experiments "on the wall", purchased dewars are simply gone
+    dewars = dewars[(dewars != -1) & (dewars < purchased_dewar_offset)]
+    low = dewar_storage[dewars, step] < inputs.M_portable_dewar_topup
+    dewar_state[dewars, step] = np.where(low, dewar_states['low'], dewar_states['store'])
+
+
+def connected_levels(dewars, step):
+    # returns levels of dewars feeding cmms experiments, triumf and purchased ones alike, -inf where no dewar
+    # triumf and purchased dewar levels are laid out in a row with "no dewar" at the end, so -1 picks it
+    levels = np.concatenate((dewar_storage[:, step], purchased_dewar_storage[:, step], [-np.inf]))
+    return levels[np.where(dewars >= purchased_dewar_offset, dewars - purchased_dewar_offset + inputs.N_dewars, dewars)]
 
 
 def set_cmms_states(step):
-    dewars_needed = []
-    for cmms in cmms_list:
-        if is_this_thing_on(step, cmms):  # cmms runs according to schedule
-            need_dewar = True
-            # if dewar already connected, check its level
-            dewar_connected = cmms_state[cmms][step-1]
-            if dewar_connected != -1:
-                # triumf dewar
-                if dewar_connected < 100:
-                    if dewar_storage[dewar_connected][step-1] > inputs.M_portable_dewar_min:
-                        need_dewar = False
-                # purchased dewar
-                else:
-                    if purchased_dewar_storage[dewar_connected-100][step-1] > inputs.M_portable_dewar_min:
-                        need_dewar = False
-            if need_dewar:
-                dewars_needed.append(cmms)
-        else:  # cmms doesn't run according to schedule
-            cmms_state[cmms][step] = -1
-            # if dewar is attached, return it
-            dewar_connected = cmms_state[cmms][step-1]
-            if dewar_connected != -1:
-                change_dewar_state(dewar_connected, 'store', step)
+    running = cmms_on[:, step]  # cmms runs according to schedule
+    dewar_connected = cmms_state[:, step-1]
+    # cmms that don't run according to schedule return their dewars
+    stopped = ~running & (dewar_connected != -1)
+    if np.count_nonzero(stopped) > 0:
+        cmms_state[stopped, step] = -1
+        return_dewars(dewar_connected[stopped], step)
+    # running cmms need a dewar if none is connected or the connected one is down to its min level
+    dewars_needed = np.nonzero(running & (connected_levels(dewar_connected, step-1) <= inputs.M_portable_dewar_min))[0]
     if len(dewars_needed) > 0:
         # find available dewars from storage
         ready_dewars = find_ready_dewars_now(step-1)
@@ -382,65 +522,44 @@ def set_cmms_states(step):
         # if not enough dewars available, purchase some
         for _ in range(len(dewars_needed) - dewars_available):
             ready_dewars.append(purchase_dewar(step))
-        for cmms, dewar in zip(dewars_needed, ready_dewars):
-            # if cmms had dewar connected, return it
-            dewar_connected = cmms_state[cmms][step-1]
-            if dewar_connected != -1:
-                change_dewar_state(dewar_connected, 'store', step)
-            # attach new dewar
-            cmms_state[cmms][step] = dewar
-            change_dewar_state(dewar, 'cmms', step)
+        new_dewars = np.array(ready_dewars[:len(dewars_needed)])
+        # if cmms had dewars connected, return them and attach new ones
+        return_dewars(dewar_connected[dewars_needed], step)
+        cmms_state[dewars_needed, step] = new_dewars
+        dewar_state[new_dewars[new_dewars < purchased_dewar_offset], step] = dewar_states['cmms']
+
+
+def sorted_by_level(selected, step):
+    # returns list of dewars selected by mask sorted by levels from high to low, higher dewar number first on ties
+    dewars = np.nonzero(selected)[0]
+    return dewars[np.lexsort((-dewars, -dewar_storage[dewars, step]))].tolist()
 
 
 def find_ready_dewars_now(step):
     # returns list of dewars ready for grabs right now sorted by levels from high to low
-    d_num = []
-    d_lvl = []
-    for d in dewars_list:
-        if dewar_state['store'][d][step]:
-            d_lvl.append(dewar_storage[d][step])
-            d_num.append(d)
-    return [k for _, k in sorted(zip(d_lvl, d_num), reverse=True)]
+    return sorted_by_level(dewar_state[:, step] == dewar_states['store'], step)
 
 
 def find_ready_dewars_future(step, period):
     # returns list of dewars that will be ready for grabs in specified period sorted by levels from high to low
     projected_level_loss = period * inputs.m_portable_dewar_loss
-    d_num = []
-    d_lvl = []
-    for d in dewars_list:
-        if dewar_state['store'][d][step]:
-            if dewar_storage[d][step] > projected_level_loss + inputs.M_portable_dewar_topup:
-                d_lvl.append(dewar_storage[d][step])
-                d_num.append(d)
-    return [k for _, k in sorted(zip(d_lvl, d_num), reverse=True)]
+    return sorted_by_level((dewar_state[:, step] == dewar_states['store']) &
+                           (dewar_storage[:, step] > projected_level_loss + inputs.M_portable_dewar_topup), step)
 
 
 def next_dewar_to_fill_now(step):
     # returns list of dewar that can be filled right now sorted by levels from high to low
-    d_num = []
-    d_lvl = []
-    for d in dewars_list:
-        if dewar_state['low'][d][step] or dewar_state['warm'][d][step]:
-            d_lvl.append(dewar_storage[d][step])
-            d_num.append(d)
-    return [k for _, k in sorted(zip(d_lvl, d_num), reverse=True)]
+    return sorted_by_level((dewar_state[:, step] == dewar_states['low']) |
+                           (dewar_state[:, step] == dewar_states['warm']), step)
 
 
 def next_dewar_to_fill_future(step, period):
     # returns list of dewars that can be filled for future readiness within specified period sorted from high to low
     projected_level_loss = period * inputs.m_portable_dewar_loss
-    d_num = []
-    d_lvl = []
-    for d in dewars_list:
-        if dewar_state['low'][d][step] or dewar_state['warm'][d][step]:
-            d_lvl.append(dewar_storage[d][step])
-            d_num.append(d)
-        if dewar_state['store'][d][step]:
-            if dewar_storage[d][step] < projected_level_loss + inputs.M_portable_dewar_topup:
-                d_lvl.append(dewar_storage[d][step])
-                d_num.append(d)
-    return [k for _, k in sorted(zip(d_lvl, d_num), reverse=True)]
+    return sorted_by_level((dewar_state[:, step] == dewar_states['low']) |
+                           (dewar_state[:, step] == dewar_states['warm']) |
+                           ((dewar_state[:, step] == dewar_states['store']) &
+                            (dewar_storage[:, step] < projected_level_loss + inputs.M_portable_dewar_topup)), step)
 
 
 def who_needs_dewars(step, period):
@@ -448,24 +567,26 @@ def who_needs_dewars(step, period):
     # TODO: cmms might require more than one dewar, e.g. during cooldown
     out = []
     t = timestamps[step]
+    levels = connected_levels(cmms_state[:, step], step)
     for c in cmms_list:
-        cmms_dewar = cmms_state[c][step]
         # if experiment will start running within period, it'll need a dewar
-        if cmms_dewar == -1:  # if cmms c is not running during step
+        if cmms_state[c][step] == -1:  # if cmms c is not running during step
             for s in inputs.schedule[c]:
                 if t <= s[0] <= t + period:  # if cmms will start operating within period
                     out.append((c, s[0]))
         # if experiment is running and will run out of LHe within period, it'll need a dewar
         else:  # if cmms c is running during step
-            # triumf dewar
-            if cmms_dewar < 100:
-                time_left = (dewar_storage[cmms_dewar][step] - inputs.M_portable_dewar_min) / inputs.cmms_consumption[c]
-            else:
-            # purchased dewar
-                time_left = (purchased_dewar_storage[cmms_dewar-100][step] -
-                             inputs.M_portable_dewar_min) / inputs.cmms_consumption[c]
-            if time_left <= period:
-                out.append((c, t + dt * int(time_left / dt)))
+            # past the end of modelled period experiment keeps drawing at its last rate
+            last = len(cmms_drawn[c]) - 1
+            step_then = step + int(period / dt)
+            drawn_then = cmms_drawn[c][min(step_then, last)] + max(step_then - last, 0) * cmms_rate[c][last] * dt
+            drawn_empty = cmms_drawn[c][step] + levels[c] - inputs.M_portable_dewar_min
+            if drawn_then - cmms_drawn[c][step] >= levels[c] - inputs.M_portable_dewar_min:
+                # dewar is down to its min level at the last step by which it hasn't given more than it had above min
+                if drawn_empty <= cmms_drawn[c][last]:
+                    out.append((c, timestamps[np.searchsorted(cmms_drawn[c], drawn_empty, side='right') - 1]))
+                else:
+                    out.append((c, timestamps[last] + (drawn_empty - cmms_drawn[c][last]) / cmms_rate[c][last]))
     return out
 
 
@@ -481,63 +602,206 @@ def we_need_more_dewars(step, period):  # not enough mana
 
 
 def set_dewar_states(step):
-    for d in dewars_list:
-        # if dewar on the wall falls below threshold, it needs a topup
-        if dewar_state['store'][d][step-1]:
-            if dewar_storage[d][step-1] <= inputs.M_portable_dewar_topup:
-                change_dewar_state(d, 'low', step)
-        # if dewar goes to 0, it warms up
-        if dewar_storage[d][step-1] < 0:
-            # only if it isn't being filled already, since cooldown is a fill at zero level
-            # if fill was interrupted during cooldown, cooldown will need to start again
-            if not dewar_state['fill'][d][step-1]:
-                change_dewar_state(d, 'warm', step)
+    state_before = dewar_state[:, step-1]
+    storage_before = dewar_storage[:, step-1]
+    state = dewar_state[:, step]  # view, so changes land in dewar_state
+    # if dewar on the wall falls below threshold, it needs a topup
+    state[(state_before == dewar_states['store']) & (storage_before <= inputs.M_portable_dewar_topup)] = \
+        dewar_states['low']
+    # if dewar goes to 0, it warms up
+    # only if it isn't being filled already, since cooldown is a fill at zero level
+    # if fill was interrupted during cooldown, cooldown will need to start again
+    warm = (storage_before < 0) & (state_before != dewar_states['fill'])
+    state[warm] = dewar_states['warm']
+    dewar_cooldown[warm] = -inputs.M_portable_dewar_cooldown
 
 
 def set_hp_compressor_states(step):
-    if linde_storage['bag'][step] > inputs.M_bag_max * inputs.x_bag_setpoint_high_1:
-        linde_state['hp_comp_1'][step] = True
-    if linde_storage['bag'][step] > inputs.M_bag_max * inputs.x_bag_setpoint_high_2:
-        linde_state['hp_comp_2'][step] = True
-    if linde_storage['bag'][step] > inputs.M_bag_max * inputs.x_bag_setpoint_high_3:
-        linde_state['hp_comp_3'][step] = True
-    if linde_storage['bag'][step] < inputs.M_bag_max * inputs.x_bag_setpoint_low_1:
-        linde_state['hp_comp_1'][step] = False
-    if linde_storage['bag'][step] < inputs.M_bag_max * inputs.x_bag_setpoint_low_2:
-        linde_state['hp_comp_2'][step] = False
-    if linde_storage['bag'][step] < inputs.M_bag_max * inputs.x_bag_setpoint_low_3:
-        linde_state['hp_comp_3'][step] = False
+    # hysteresis: compressor starts above its high setpoint, stops below its low setpoint, otherwise keeps its state
+    bag = linde_storage['bag'][step]
+    hp_comp_state[:, step] = (hp_comp_state[:, step-1] | (bag > inputs.M_bag_setpoints_high)) & \
+                             ~(bag < inputs.M_bag_setpoints_low)
 
 
-def set_linde_states(step):
-    # TODO: handle situation when dewar is being filled and ucn transfer starts to then return to filling the dewar
+def linde_run_by_thresholds(step):
+    # tells if linde should run according to main dewar level and hp storage thresholds
+    run = linde_on('run', step-1)
     # start linde if main dewar level is below threshold
     if linde_storage['dewar'][step-1] < inputs.M_linde_dewar_start:
-        linde_state[step]['run'] = True
+        run = True
+    # if hp storage too low or dewar too high, shutdown linde
+    if linde_storage['hp'][step-1] < inputs.M_hp_storage_min:
+        run = False
+    if linde_storage['dewar'][step-1] > inputs.M_linde_dewar_max:
+        run = False
+    return run
+
+
+def schedule_linde(step):
+    # linde can only be started or stopped at decision points within operator time window, but trips stop it any time
+    # at decision points look-ahead decision is taken if there is one, see plan_linde
+    if inputs.linde_window is None:
+        return
+    if linde_storage['hp'][step-1] < inputs.M_hp_storage_trip or \
+            linde_storage['dewar'][step-1] > inputs.M_linde_dewar_trip:
+        set_linde('run', step, False)
+    elif not linde_decision_step[step]:
+        if linde_on('run', step) != linde_on('run', step-1):
+            linde_held.value = True
+        set_linde('run', step, linde_on('run', step-1))
+    elif step in linde_plan:
+        set_linde('run', step, linde_plan[step])
+
+
+def plan_linde(step):
+    # decides whether linde should run from decision point at step on
+    # thresholds decide, unless they want to start or stop linde, or time window is about to close and holding linde
+    # state until it reopens goes against them: then the future is simulated for both options and the cheapest one is
+    # taken, see lookahead_cost
+    # simulated future of the taken option is kept up to the next decision point, so it isn't simulated again
+    run = linde_run_by_thresholds(step)
+    hold = run == linde_on('run', step-1)
+    if hold and not linde_last_decision_step[step]:
+        return run
+    # linde can't be kept running outside of hp storage and main dewar limits
+    if linde_storage['hp'][step-1] < inputs.M_hp_storage_min or \
+            linde_storage['dewar'][step-1] > inputs.M_linde_dewar_max:
+        return run
+    step_to = min(step + int(inputs.t_linde_lookahead / dt), total_steps)
+    step_next = linde_decision_steps[np.searchsorted(linde_decision_steps, step, side='right'):][:1]
+    step_keep = min(step_next[0] if len(step_next) > 0 else total_steps, step_to)
+    saved = save_state(step, step_to)
+    costs = {}
+    kept = {}
+    lookahead_active.value = True
+    for option in (run, not run):  # thresholds go first to win ties
+        linde_plan[step] = option
+        linde_held.value = False
+        del lookahead_log[:]
+        try:
+            for i in range(step, step_keep):
+                advance(i)
+            kept[option] = (save_state(step, step_keep), list(lookahead_log))
+            # thresholds agree with holding linde state until the next decision point, there's nothing to compare
+            if hold and not linde_held.value:
+                restore_state(saved)
+                break
+            for i in range(step_keep, step_to):
+                advance(i)
+            costs[option] = lookahead_cost(saved, step, step_to)
+        except IterationStopped:
+            costs[option] = (np.inf, np.inf)
+        restore_state(saved)
+    lookahead_active.value = False
+    del linde_plan[step]
+    run = min(costs, key=costs.get) if costs else run
+    if run in kept:
+        restore_state(kept[run][0])
+        for msg in kept[run][1]:
+            log(msg)
+        simulated_ahead.value = step_keep
+    return run
+
+
+def lookahead_cost(saved, step_from, step_to):
+    # returns cost of simulated future as (ucn shortfall, helium cost), so ucn supply always goes first
+    # ucn shortfall: helium ucn cryostat consumed without having it [kg]
+    # helium cost: vented and linde losses, cooldowns of warmed up dewars and purchased dewars minus liquid helium
+    # gained in portable dewars and in main dewar up to its max level [kg]
+    first = step_from - 1
+    last = step_to - 1
+    ucn_shortfall = max(-np.min(linde_storage['ucn'][step_from:step_to]), 0) - max(-linde_storage['ucn'][first], 0)
+    lost = linde_storage['loss'][last] - linde_storage['loss'][first]
+    warm = dewar_states['warm']
+    warmups = np.count_nonzero((dewar_state[:, step_from:step_to] == warm) & (dewar_state[:, first:last] != warm))
+    purchases = dewars_purchased.value - saved['dewars_purchased']
+    # ucn level is clamped at zero during cooldown, so helium consumed without having it isn't a negative level
+    ucn_shortfall += np.sum(clamped['ucn'][step_from:step_to])
+    liquid_first = min(linde_storage['dewar'][first], inputs.M_linde_dewar_max) + \
+                   np.sum(np.maximum(dewar_storage[:, first], 0))
+    liquid_last = min(linde_storage['dewar'][last], inputs.M_linde_dewar_max) + \
+                  np.sum(np.maximum(dewar_storage[:, last], 0))
+    helium_cost = lost + warmups * inputs.M_portable_dewar_cooldown + purchases * inputs.M_portable_dewar_full - \
+                  (liquid_last - liquid_first)
+    return max(ucn_shortfall, 0), helium_cost
+
+
+def save_state(step_from, step_to):
+    # copies everything advance changes between step_from and step_to (not included), so it could be undone
+    return {'step_from': step_from,
+            'step_to': step_to,
+            'linde_storage': linde_storage[step_from:step_to].copy(),
+            'linde_state': linde_state[step_from:step_to].copy(),
+            'linde_production': linde_production[step_from:step_to].copy(),
+            'clamped': clamped[step_from:step_to].copy(),
+            'hp_comp_state': hp_comp_state[:, step_from:step_to].copy(),
+            'dewar_storage': dewar_storage[:, step_from:step_to].copy(),
+            'dewar_state': dewar_state[:, step_from:step_to].copy(),
+            'purchased_dewar_storage': purchased_dewar_storage[:, step_from:step_to].copy(),
+            'cmms_state': cmms_state[:, step_from:step_to].copy(),
+            'ucn_state': ucn_state[step_from:step_to].copy(),
+            'dewar_cooldown': dewar_cooldown.copy(),
+            'purchased_dewar_step': purchased_dewar_step.copy(),
+            'dewars_purchased': dewars_purchased.value,
+            'hp_comp_run_time': hp_comp_run_time.copy(),
+            'hp_comp_starts': hp_comp_starts.copy(),
+            'linde_state_logbook': dict(linde_state_logbook),
+            'dewar_state_logbook': dict(dewar_state_logbook),
+            'ucn_state_logbook': dict(ucn_state_logbook),
+            'cmms_state_logbook': list(cmms_state_logbook)}
+
+
+def restore_state(saved):
+    # undoes everything advance changed since save_state
+    step_from = saved['step_from']
+    step_to = saved['step_to']
+    linde_storage[step_from:step_to] = saved['linde_storage']
+    linde_state[step_from:step_to] = saved['linde_state']
+    linde_production[step_from:step_to] = saved['linde_production']
+    clamped[step_from:step_to] = saved['clamped']
+    hp_comp_state[:, step_from:step_to] = saved['hp_comp_state']
+    dewar_storage[:, step_from:step_to] = saved['dewar_storage']
+    dewar_state[:, step_from:step_to] = saved['dewar_state']
+    purchased_dewar_storage[:, step_from:step_to] = saved['purchased_dewar_storage']
+    cmms_state[:, step_from:step_to] = saved['cmms_state']
+    ucn_state[step_from:step_to] = saved['ucn_state']
+    dewar_cooldown[:] = saved['dewar_cooldown']
+    purchased_dewar_step[:] = saved['purchased_dewar_step']
+    dewars_purchased.value = saved['dewars_purchased']
+    hp_comp_run_time[:] = saved['hp_comp_run_time']
+    hp_comp_starts[:] = saved['hp_comp_starts']
+    for logbook in ['linde_state_logbook', 'dewar_state_logbook', 'ucn_state_logbook']:
+        globals()[logbook].clear()
+        globals()[logbook].update(saved[logbook])
+    cmms_state_logbook[:] = saved['cmms_state_logbook']
+
+
+def set_linde_states(step):
+    # TODO: handle situation when dewar is being filled and ucn transfer starts to then return to filling the dewar
+    set_linde('run', step, linde_run_by_thresholds(step))
+    schedule_linde(step)
     # if main dewar is too low, disconnect all consumers
     if linde_storage['dewar'][step-1] < inputs.M_linde_dewar_min_safe:
-        linde_state[step]['filling'] = False
-        for d in dewars_list:
-            if dewar_state['fill'][d][step-1]:
-                change_dewar_state(d, 'store', step)
-                break
-        linde_state['transfer'][step] = False
+        set_linde('filling', step, False)
+        d = dewar_being_filled(step-1)
+        if d != -1:
+            change_dewar_state(d, 'store', step)
+        set_linde('transfer', step, False)
     elif linde_storage['dewar'][step-1] > inputs.M_linde_dewar_min_okay:  # enough helium in main dewar
         # if not transferring, see if transfers needed
-        if not linde_state['transfer'][step-1]:
+        if not linde_on('transfer', step-1):
             # if ucn running and level low, start transfer - ucn gets the priority over portable dewars
-            if ucn_state['static'][step-1]:
+            if ucn_on('static', step-1):
                 if linde_storage['ucn'][step-1] < inputs.M_ucn_4K_min:
-                    linde_state['transfer'][step] = True
+                    set_linde('transfer', step, True)
                     # if filling at the moment, stop the fill and place dewar "on the wall"
-                    if linde_state['filling'][step-1]:
-                        linde_state['filling'][step] = False
-                        for d in dewars_list:
-                            if dewar_state['fill'][d][step-1]:
-                                change_dewar_state(d, 'store', step)
-                                break
+                    if linde_on('filling', step-1):
+                        set_linde('filling', step, False)
+                        d = dewar_being_filled(step-1)
+                        if d != -1:
+                            change_dewar_state(d, 'store', step)
             # if not transferring or filling now
-            if not linde_state[step]['transfer'] and not linde_state[step]['filling']:
+            if not linde_on('transfer', step) and not linde_on('filling', step):
                 # and have enough liquid in main dewar
                 if linde_storage['dewar'][step] > inputs.M_linde_dewar_fill_ok:
                     # and need to fill a portable dewar
@@ -545,76 +809,151 @@ def set_linde_states(step):
                         d = next_dewar_to_fill_future(step-1, inputs.prediction_window)
                         # then start filling
                         if len(d) > 0:  # if all dewars are busy, wait for empty one to appear
-                            linde_state['filling'][step] = True
+                            set_linde('filling', step, True)
                             change_dewar_state(d[0], 'fill', step)
         # if transferring, check if ucn is full
-        if linde_state[step-1]['transfer']:
+        if linde_on('transfer', step-1):
             if linde_storage['ucn'][step-1] > inputs.M_ucn_4K_max:
-                linde_state[step]['transfer'] = False
+                set_linde('transfer', step, False)
         # if filling portable dewar check if it's full
-        if linde_state[step-1]['filling']:
-            for d in dewars_list:
-                if dewar_state['fill'][d][step-1]:
-                    # detach if dewar is full
-                    if dewar_storage[d][step-1] > inputs.M_portable_dewar_full:
-                        change_dewar_state(d, 'store', step)
-                        linde_state[step]['filling'] = False
-                        break
+        if linde_on('filling', step-1):
+            d = dewar_being_filled(step-1)
+            # detach if dewar is full
+            if d != -1 and dewar_storage[d][step-1] > inputs.M_portable_dewar_full:
+                change_dewar_state(d, 'store', step)
+                set_linde('filling', step, False)
         # if filling portable dewar check if it has enough LHe and it must be taken at the text step
-        if linde_state[step - 1]['filling']:
-            for d in dewars_list:
-                if dewar_state['fill'][d][step - 1]:
-                    if dewar_storage[d][step-1] > inputs.M_portable_dewar_topup:
-                        if len(who_needs_dewars(step-1, 2*dt)) > len(find_ready_dewars_now(step)):
-                            change_dewar_state(d, 'store', step)
-                            linde_state[step]['filling'] = False
-                            break
-    # if hp storage too low or dewar too high, shutdown linde
-    if linde_storage['hp'][step-1] < inputs.M_hp_storage_min:
-        linde_state[step]['run'] = False
-    if linde_storage['dewar'][step-1] > inputs.M_linde_dewar_max:
-        linde_state[step]['run'] = False
+        if linde_on('filling', step - 1):
+            d = dewar_being_filled(step-1)
+            if d != -1 and dewar_storage[d][step-1] > inputs.M_portable_dewar_topup:
+                if len(who_needs_dewars(step-1, 2*dt)) > len(find_ready_dewars_now(step)):
+                    change_dewar_state(d, 'store', step)
+                    set_linde('filling', step, False)
+    # when replaying historian logs, measured state overrides the thresholds
+    if replay and replay['linde_run'][step] != -1:
+        set_linde('run', step, replay['linde_run'][step] == 1)
     # keep transfer line cold when ucn running
-    if ucn_state['static'][step-1]:
-        if not linde_state[step]['transfer']:
-            linde_state[step]['transfer_trickle'] = True
+    if ucn_on('static', step-1):
+        if not linde_on('transfer', step):
+            set_linde('transfer_trickle', step, True)
     # turn off trickle flow if transfer taking place
-    if linde_state[step]['transfer']:
-        linde_state[step]['transfer_trickle'] = False
+    if linde_on('transfer', step):
+        set_linde('transfer_trickle', step, False)
 
 
 def sanity_checks(step):  # yeah, I know
-    if linde_state['filling'][step]:
-        fail = True
-        for d in dewars_list:
-            if dewar_state['fill'][d][step]:
-                fail = False
-                break
-        if fail:
-            quit_iteration(step, 'linde is filling to nowhere :(')
-    if not linde_state['filling'][step]:
-        fail = False
-        for d in dewars_list:
-            if dewar_state['fill'][d][step]:
-                fail = True
-                break
-        if fail:
-            quit_iteration(step, 'dewar is filling from nowhere :(')
-    ctr = 0
-    for d in dewars_list:
-        if dewar_state['fill'][d][step]:
-            ctr += 1
+    ctr = np.count_nonzero(dewar_state[:, step] == dewar_states['fill'])
+    if linde_on('filling', step) and ctr == 0:
+        quit_iteration(step, 'linde is filling to nowhere :(')
+    if not linde_on('filling', step) and ctr > 0:
+        quit_iteration(step, 'dewar is filling from nowhere :(')
     if ctr > 1:
         quit_iteration(step, 'filling multiple dewars simultaneously')
-    if linde_state['filling'][step] and linde_state['transfer'][step]:
+    if linde_on('filling', step) and linde_on('transfer', step):
         quit_iteration(step, 'filling ucn and dewar simultaneously')
 
 
-def quit_iteration(step, msg):
-    print(msg)
-    update_charts(step)
-    plt.savefig('plot.png')
-    sys.exit()
+def audit_states(step_from, step_to):
+    # vectorized version of sanity_checks over the history between step_from and step_to (not included)
+    # stops the iteration at the earliest inconsistent step
+    filling = linde_history('filling', step_from, step_to)
+    transfer = linde_history('transfer', step_from, step_to)
+    dewars_filling = np.sum(dewar_state[:, step_from:step_to] == dewar_states['fill'], axis=0)
+    checks = [(filling & (dewars_filling == 0), 'linde is filling to nowhere :('),
+              (~filling & (dewars_filling > 0), 'dewar is filling from nowhere :('),
+              (dewars_filling > 1, 'filling multiple dewars simultaneously'),
+              (filling & transfer, 'filling ucn and dewar simultaneously'),
+              (np.any(dewar_state[:, step_from:step_to] >= len(dewar_states), axis=0), 'dewar is in unknown state')]
+    first_fail = None
+    for fail, msg in checks:
+        if np.any(fail):
+            step = step_from + int(np.argmax(fail))
+            if first_fail is None or step < first_fail[0]:
+                first_fail = (step, msg)
+    if first_fail is not None:
+        quit_iteration(*first_fail)
+
+
+def total_inventory(step_from, step_to):
+    # returns total amount of helium in linde storage, portable and purchased dewars at each step [kg]
+    inventory = np.sum(dewar_storage[:, step_from:step_to], axis=0) + \
+                np.sum(purchased_dewar_storage[:, step_from:step_to], axis=0)
+    for k in linde_storage.dtype.names:
+        inventory += linde_storage[k][step_from:step_to]
+    return inventory
+
+
+def audit_mass_balance(step_from, step_to, step_initial=0):
+    # checks that helium is conserved between step_from and step_to (not included), i.e. that total inventory of
+    # linde storage, portable and purchased dewars minus helium of purchased dewars equals the initial inventory
+    # step_initial is the step the run started from, e.g. the warm-started step of a forecast
+    # returns the first leaking step and its magnitude [kg], or (None, 0.0) if no leaks found
+    # positive leak means helium appeared out of nowhere, negative leak means it disappeared
+    # helium created by levels clamped at zero is recorded by the model (see clamped), so it isn't reported as a leak
+    audit_from = max(step_from - 1, step_initial)  # one step before is required to catch a leak at step_from
+    steps = np.arange(audit_from, step_to)
+    inventory = total_inventory(audit_from, step_to)
+    purchases = purchased_dewar_step[:dewars_purchased.value]  # sorted since dewars are purchased one after another
+    purchased = np.searchsorted(purchases, steps, side='right') * inputs.M_portable_dewar_full
+    imbalance = inventory - purchased - total_inventory(step_initial, step_initial + 1)[0] + \
+                np.searchsorted(purchases, step_initial, side='right') * inputs.M_portable_dewar_full
+    created = clamped['ucn'][steps] + clamped['dewars'][steps]
+    leaks = np.diff(imbalance, prepend=imbalance[0]) - np.concatenate(([0.0], created[1:]))
+    leaking = np.abs(leaks) > inputs.M_mass_balance_tolerance
+    if not np.any(leaking):
+        return None, 0.0
+    first_leak = int(np.argmax(leaking))
+    print(f'mass balance: {np.count_nonzero(leaking)} leaks between steps {step_from} and {step_to}, '
+          f'first at step {steps[first_leak]} of {leaks[first_leak]:.3e} kg, '
+          f'total imbalance {imbalance[-1]:.3e} kg, '
+          f'of which {np.sum(clamped["ucn"][step_initial+1:step_to] + clamped["dewars"][step_initial+1:step_to]):.3e} kg '
+          f'created by levels clamped at zero')
+    return int(steps[first_leak]), float(leaks[first_leak])
+
+
+def audit(step_from, step_to, step_initial=0):
+    # audits history between step_from and step_to (not included) simulated by any driver: reports helium leaks and
+    # stops the iteration at the earliest inconsistent step, with fast_mode enabled it's the only consistency check
+    audit_mass_balance(step_from, step_to, step_initial)
+    audit_states(step_from, step_to)
+
+
+def iterate(step):
+    # simulates a single step, making scheduling decisions first if it's a decision point
+    # steps already simulated by look-ahead of a decision are only checked
+    if inputs.linde_window is not None and linde_decision_step[step] and not lookahead_active.value:
+        linde_plan[step] = plan_linde(step)
+    if step >= simulated_ahead.value:
+        advance(step)
+    elif not inputs.fast_mode:
+        sanity_checks(step)
+
+
+def advance(step):
+    # sets the states and moves helium around for a single step
+    carry_amounts(step)
+    carry_states(step)
+    set_hp_compressor_states(step)
+    set_ucn_states(step)
+    set_cmms_states(step)
+    set_dewar_states(step)
+    set_linde_states(step)
+    log_linde_state(step)
+    log_hp_comp_state(step)
+    log_dewar_state(step)
+    log_ucn_state(step)
+    log_cmms_state(step)
+    op_hp_compressors(step)
+    op_linde(step)
+    op_ucn(step)
+    op_cmms(step)
+    op_dewars(step)
+    if not inputs.fast_mode and not lookahead_active.value:
+        sanity_checks(step)
+
+
+def quit_iteration(step, msg, reason=InconsistentState):
+    raise reason(step, msg)
 
 
 def maximize():
@@ -672,7 +1011,7 @@ def update_charts(step):
     for cmms in cmms_list:
         charts['experiments'][cmms].set_data(timestamps_days[:step], -cmms_state[cmms][:step])
     charts['experiments']['ucn'].set_data(timestamps_days[:step],
-        0.5*ucn_state['static'][:step]+1.0*ucn_state['beam'][:step]+1.5*ucn_state['cooldown'][:step])
+        0.5*ucn_history('static', 0, step)+1.0*ucn_history('beam', 0, step)+1.5*ucn_history('cooldown', 0, step))
     charts['linde production'].set_data(timestamps_days[:step], linde_production[:step])
     fig.canvas.draw()
     plt.pause(0.1)
@@ -688,37 +1027,96 @@ def hash_results(ndarrays):
             f.write(f'{name}: {md5}\n')
 
 
+def save_results(path, step_to, stopped=None):
+    # saves histories up to step_to (not included), counters, state tables and inputs to a compressed archive
+    # each history is cut in chunks of inputs.t_archive_chunk and each chunk is a separate member of the archive,
+    # so replot.py only reads and decompresses the histories and time range it plots
+    chunk_steps = max(1, int(inputs.t_archive_chunk / dt))
+    histories = {f'linde_storage.{s}': linde_storage[s] for s in linde_storage.dtype.names}
+    histories['linde_state'] = linde_state
+    histories['linde_production'] = linde_production
+    histories['hp_comp_state'] = hp_comp_state
+    histories['dewar_storage'] = dewar_storage
+    histories['dewar_state'] = dewar_state
+    histories['purchased_dewar_storage'] = purchased_dewar_storage[:dewars_purchased.value]
+    histories['cmms_state'] = cmms_state
+    histories['ucn_state'] = ucn_state
+    members = {}
+    for name, history in histories.items():
+        for chunk, step_from in enumerate(range(0, step_to, chunk_steps)):
+            members[f'{name}/{chunk}'] = history[..., step_from:min(step_from + chunk_steps, step_to)]
+    run = {'start_time': inputs.start_time, 'timestep': dt, 'total_steps': total_steps, 'steps': step_to,
+           'chunk_steps': chunk_steps, 'stopped': None if stopped is None else f'step {stopped.step}: {stopped}',
+           'dewars_purchased': dewars_purchased.value,
+           'purchased_dewar_step': purchased_dewar_step[:dewars_purchased.value].tolist(),
+           'hp_comp_run_time': hp_comp_run_time.tolist(), 'hp_comp_starts': hp_comp_starts.tolist(),
+           'linde_storage': list(linde_storage.dtype.names),
+           'dewar_states': {name: int(code) for name, code in dewar_states.items()},
+           'linde_flags': {name: int(flag) for name, flag in linde_flags.items()},
+           'ucn_flags': {name: int(flag) for name, flag in ucn_flags.items()},
+           'purchased_dewar_offset': purchased_dewar_offset}
+    # inputs are archived as json: arrays as lists, anything json can't hold (e.g. time zone) as a string
+    archived_inputs = {}
+    for name, value in vars(inputs).items():
+        if name.startswith('_') or callable(value) or isinstance(value, types.ModuleType):
+            continue
+        try:
+            archived_inputs[name] = json.loads(json.dumps(value, default=lambda v: v.tolist() if hasattr(v, 'tolist')
+                                                          else str(v)))
+        except TypeError:
+            archived_inputs[name] = str(value)
+    members['run'] = np.array(json.dumps(run))
+    members['inputs'] = np.array(json.dumps(archived_inputs))
+    np.savez_compressed(path, **members)
+
+
 if __name__ == "__main__":
 
+    if inputs.historian_replay_files:
+        measured = historian.align(inputs.historian_replay_files, timestamps)
+        replay.update(historian.replay_states(measured))
+
     initialize()
     initialize_charts()
     plot_every = 10000
 
-    for i in range(1, total_steps):
-        carry_amounts(i)
-        carry_states(i)
-        set_hp_compressor_states(i)
-        set_ucn_states(i)
-        set_cmms_states(i)
-        set_dewar_states(i)
-        set_linde_states(i)
-        log_linde_state(i)
-        log_dewar_state(i)
-        log_ucn_state(i)
-        log_cmms_state(i)
-        op_hp_compressors(i)
-        op_linde(i)
-        op_ucn(i)
-        op_cmms(i)
-        op_dewars(i)
-        sanity_checks(i)
-
-        if i % plot_every == 0:
-            print(f'step {i}')
-            update_charts(i)
+    audited = 1  # steps before this one passed the state audit
+    try:
+        for i in range(1, total_steps):
+            iterate(i)
+
+            if i % plot_every == 0:
+                print(f'step {i}')
+                audit_states(audited, i + 1)
+                audited = i + 1
+                update_charts(i)
+
+        audit_states(audited, total_steps)
+    except IterationStopped as e:
+        print(e)
+        # history up to the stopping step is audited too, a leak or an earlier inconsistency may explain the stop
+        audit_mass_balance(0, e.step)
+        try:
+            audit_states(audited, e.step)
+        except InconsistentState as inconsistent:
+            print(f'step {inconsistent.step}: {inconsistent}')
+        update_charts(e.step)
+        plt.savefig('plot.png')
+        save_results(inputs.archive_file, e.step, e)
+        sys.exit()
+    audit_mass_balance(0, total_steps)
 
     plt.savefig('plot.png')
+    save_results(inputs.archive_file, total_steps)
+
+    if replay:
+        historian.residuals(measured, {'hp': linde_storage['hp'], 'bag': linde_storage['bag'],
+                                       'dewar': linde_storage['dewar'], 'ucn': linde_storage['ucn'],
+                                       'dewar_storage': dewar_storage})
 
     print(f'total dewars purchased: {dewars_purchased}')
+    for c in range(inputs.N_hp_compressors):
+        print(f'hp compressor {c}: {hp_comp_run_time[c] / 3600:.1f} run hours, {hp_comp_starts[c]} starts')
 
-    hash_results([linde_storage, linde_state, dewar_storage, dewar_state, purchased_dewar_storage, cmms_state, ucn_state])
\ No newline at end of file
+    hash_results([linde_storage, linde_state, hp_comp_state, dewar_storage, dewar_state, purchased_dewar_storage,
+                  cmms_state, ucn_state])
\ No newline at end of file
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# re-plots runs straight from their results archives (see main.save_results), nothing is re-simulated
+# archives are opened lazily: only histories of the requested charts are read, and only chunks covering the time window
+#
+# usage: python replot.py results.npz [other.npz ...] [--from '2027-08-01 00:00:00'] [--to '2027-09-01 00:00:00']
+#                         [--charts bag dewar portable_dewars ...] [--every 10] [--out replot.png]
+# several archives are overlaid, one colour per run
+
+import argparse
+import json
+import numpy as np
+import matplotlib.pyplot as plt
+import inputs
+
+# charts of main.initialize_charts after the linde storage ones, in the same order
+other_charts = ['portable dewars', 'purchased dewars', 'experiments', 'linde production']
+
+
+def open_run(path):
+    # returns opened archive and description of its run, histories are only read from disk when asked for
+    archive = np.load(path)
+    run = json.loads(str(archive['run']))
+    run['inputs'] = json.loads(str(archive['inputs']))
+    run['path'] = path
+    return archive, run
+
+
+def window(run, t_from, t_to):
+    # returns steps of run between times t_from and t_to (included) as step_from, step_to (not included)
+    # None stands for start or end of the run
+    step_from = 0
+    step_to = run['steps']
+    if t_from is not None:
+        step_from = int(np.clip(np.ceil((t_from - run['start_time']) / run['timestep']), 0, run['steps']))
+    if t_to is not None:
+        step_to = int(np.clip((t_to - run['start_time']) // run['timestep'] + 1, 0, run['steps']))
+    return step_from, step_to
+
+
+def read(archive, run, name, step_from, step_to):
+    # returns history between step_from and step_to (not included), only decompressing chunks that cover them
+    chunk_steps = run['chunk_steps']
+    first_chunk = step_from // chunk_steps
+    last_chunk = (step_to - 1) // chunk_steps
+    history = np.concatenate([archive[f'{name}/{chunk}'] for chunk in range(first_chunk, last_chunk + 1)], axis=-1)
+    return history[..., step_from - first_chunk * chunk_steps:step_to - first_chunk * chunk_steps]
+
+
+def chart_lines(archive, run, chart, step_from, step_to):
+    # returns lines of chart as rows, the same ones main.update_charts draws
+    if chart in run['linde_storage']:
+        return read(archive, run, f'linde_storage.{chart}', step_from, step_to)[None, :]
+    if chart == 'portable dewars':
+        return read(archive, run, 'dewar_storage', step_from, step_to)
+    if chart == 'purchased dewars':
+        return read(archive, run, 'purchased_dewar_storage', step_from, step_to)
+    if chart == 'experiments':
+        cmms = -read(archive, run, 'cmms_state', step_from, step_to).astype(float)
+        ucn_state = read(archive, run, 'ucn_state', step_from, step_to)
+        ucn = 0.5 * ((ucn_state & run['ucn_flags']['static']) != 0) + \
+              1.0 * ((ucn_state & run['ucn_flags']['beam']) != 0) + \
+              1.5 * ((ucn_state & run['ucn_flags']['cooldown']) != 0)
+        return np.vstack([cmms, ucn])
+    if chart == 'linde production':
+        return read(archive, run, 'linde_production', step_from, step_to)[None, :]
+    raise ValueError(f'unknown chart {chart}')
+
+
+def plot(runs, charts, t_from=None, t_to=None, every=1):
+    # plots charts of runs between times t_from and t_to (None for start or end of runs), every given step
+    # time axis is in days since start of the earliest run, so runs with different start times line up
+    origin = min(run['start_time'] for archive, run in runs)
+    fig, ax = plt.subplots(len(charts), sharex=True, squeeze=False, figsize=(16, 1.6 * len(charts) + 1))
+    ax = ax[:, 0]
+    plt.xlabel('time [days]')
+    y_max = np.zeros(len(charts))
+    for k, (archive, run) in enumerate(runs):
+        step_from, step_to = window(run, t_from, t_to)
+        if step_to <= step_from:
+            print(f'{run["path"]}: nothing to plot within the time window')
+            continue
+        if run['stopped'] is not None:
+            print(f'{run["path"]}: iteration stopped at {run["stopped"]}')
+        colour = f'C{k % 10}' if len(runs) > 1 else None
+        days = (run['start_time'] - origin + np.arange(step_from, step_to, every) * run['timestep']) / 24 / 3600
+        for i, chart in enumerate(charts):
+            lines = chart_lines(archive, run, chart, step_from, step_to)[:, ::every]
+            for line in lines:
+                ax[i].plot(days, line, linewidth=0.5, color=colour)
+            if len(lines) > 0 and lines.shape[1] > 0:
+                y_max[i] = max(y_max[i], np.max(lines))
+        if len(runs) > 1:
+            ax[0].plot([], [], color=colour, label=run['path'])
+    # same limits as main.update_charts
+    for i, chart in enumerate(charts):
+        ax[i].set_title(chart)
+        if chart in ['portable dewars', 'purchased dewars']:
+            ax[i].set_ylim(0, max(run['inputs']['M_portable_dewar_full'] for archive, run in runs) * 1.05)
+        elif chart == 'experiments':
+            ax[i].set_ylim(0, 2.5)
+        elif chart == 'linde production':
+            ax[i].set_ylim(0, max(run['inputs']['v_linde_dewar_L_hr'] for archive, run in runs) + 10)
+        elif y_max[i] > 0:
+            ax[i].set_ylim(0, y_max[i] * 1.05)
+    t_end = max(run['start_time'] + (run['steps'] - 1) * run['timestep'] for archive, run in runs)
+    ax[0].set_xlim((max(t_from, origin) - origin) / 24 / 3600 if t_from is not None else 0,
+                   (min(t_to, t_end) - origin) / 24 / 3600 if t_to is not None else (t_end - origin) / 24 / 3600)
+    if len(runs) > 1:
+        ax[0].legend(loc='upper right', fontsize='small')
+    plt.tight_layout()
+    return fig
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='re-plots runs from their results archives')
+    parser.add_argument('archives', nargs='+', help='results archives saved by main.py, several ones are overlaid')
+    parser.add_argument('--from', dest='t_from', help='start of time window, local time YYYY-MM-DD HH:MM:SS')
+    parser.add_argument('--to', dest='t_to', help='end of time window, local time YYYY-MM-DD HH:MM:SS')
+    parser.add_argument('--charts', nargs='+', help='charts to plot (default all), underscores stand for spaces, '
+                                                    'e.g. bag dewar portable_dewars experiments')
+    parser.add_argument('--every', type=int, default=1, help='plot every given step (default 1)')
+    parser.add_argument('--out', default='replot.png', help='image to save (default replot.png)')
+    args = parser.parse_args()
+
+    runs = [open_run(path) for path in args.archives]
+    t_from = inputs.parse_time(args.t_from) if args.t_from is not None else None
+    t_to = inputs.parse_time(args.t_to) if args.t_to is not None else None
+    all_charts = runs[0][1]['linde_storage'] + other_charts
+    if args.charts is None:
+        charts = all_charts
+    else:
+        charts = [c.replace('_', ' ') for c in args.charts]
+        for c in charts:
+            if c not in all_charts:
+                parser.error(f'unknown chart {c}, available charts: {", ".join(c.replace(" ", "_") for c in all_charts)}')
+    plot(runs, charts, t_from, t_to, args.every)
+    plt.savefig(args.out)
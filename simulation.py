@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+# embeddable model runs: each simulation owns its state, so runs can be repeated, interleaved and driven step by step
+# from notebooks or other programs within one process, without re-importing the model
+# model grid (timestamps, schedules, consumption profiles) is built once when main.py is imported and shared by all
+# runs aren't concurrent: state and inputs of a run are swapped into module globals of main.py and inputs.py while
+# it's simulated, so runs can only be interleaved within one thread, and anything else reading inputs.py meanwhile
+# sees the inputs of that run
+#
+#     sim = Simulation(overrides={'V_bag_max_cu_ft': 1000})
+#     sim.run_until('2027-06-01 00:00:00')
+#     for snapshot in sim.stream(every=24*60):
+#         print(snapshot['timestamps'][-1], snapshot['linde_storage']['dewar'][-1])
+
+import collections
+import numpy as np
+from ctypes import c_int32, c_bool
+import inputs
+import main
+from thermophysical import T_env, d_from_p_sl, d_from_p_t, h_from_p_sl, h_from_p_sv, r_from_p_sl
+
+# inputs baked into the model grid when main.py is imported, they can't differ between simulations
+grid_inputs = {'timestep', 'start_time', 'end_time', 'triumf_tz', 'schedule', 'linde_window', 't_linde_decision',
+               'N_dewars', 'N_dewars_purchased_max', 'N_hp_compressors', 'cmms_consumption', 'cmms_consumption_series',
+               'cmms_consumption_weekend', 'cmms_consumption_surge', 'cmms_consumption_segments',
+               'p_portable_dewar', 'd_portable_dewar'}  # cmms_consumption is calculated from d_portable_dewar
+
+
+# inputs derived from other inputs and read by the model: name: (inputs it's calculated from, calculation)
+# calculations are the ones of inputs.py, in the same order, so later ones can use earlier ones
+derived_inputs = {
+    'p_linde_dewar': (['p_linde_dewar_gauge_psi'], lambda i: 101325 + i['p_linde_dewar_gauge_psi'] * 6894.76),
+    'd_linde_dewar': (['p_linde_dewar'], lambda i: d_from_p_sl(i['p_linde_dewar'])),
+    'm_linde_dewar': (['v_linde_dewar_L_hr', 'd_linde_dewar'],
+                      lambda i: i['v_linde_dewar_L_hr'] * 1e-3 / 3600 * i['d_linde_dewar']),
+    'M_linde_dewar_min_safe': (['V_linde_dewar_min_safe_L', 'd_linde_dewar'],
+                               lambda i: i['V_linde_dewar_min_safe_L'] * 1e-3 * i['d_linde_dewar']),
+    'M_linde_dewar_min_okay': (['V_linde_dewar_min_okay_L', 'd_linde_dewar'],
+                               lambda i: i['V_linde_dewar_min_okay_L'] * 1e-3 * i['d_linde_dewar']),
+    'M_linde_dewar_max': (['V_linde_dewar_max_L', 'd_linde_dewar'],
+                          lambda i: i['V_linde_dewar_max_L'] * 1e-3 * i['d_linde_dewar']),
+    'M_linde_dewar_start': (['V_linde_dewar_start_L', 'd_linde_dewar'],
+                            lambda i: i['V_linde_dewar_start_L'] * 1e-3 * i['d_linde_dewar']),
+    'M_linde_dewar_trip': (['V_linde_dewar_trip_L', 'd_linde_dewar'],
+                           lambda i: i['V_linde_dewar_trip_L'] * 1e-3 * i['d_linde_dewar']),
+    'm_linde_dewar_loss': (['M_linde_dewar_max', 'x_linde_dewar_loss_day'],
+                           lambda i: i['M_linde_dewar_max'] * i['x_linde_dewar_loss_day'] / 24 / 3600),
+    'm_dewar_pull_run': (['v_dewar_pull_run_L_hr', 'd_linde_dewar'],
+                         lambda i: i['v_dewar_pull_run_L_hr'] * 1e-3 * i['d_linde_dewar'] / 3600),
+    'm_dewar_pull_off': (['v_dewar_pull_off_L_hr', 'd_linde_dewar'],
+                         lambda i: i['v_dewar_pull_off_L_hr'] * 1e-3 * i['d_linde_dewar'] / 3600),
+    'm_linde_loss': (['m_linde_loss_g_s'], lambda i: i['m_linde_loss_g_s'] * 1e-3),
+    'p_hp_storage_min': (['p_hp_storage_min_psi'], lambda i: i['p_hp_storage_min_psi'] * 6894.76),
+    'p_hp_storage_trip': (['p_hp_storage_trip_psi'], lambda i: i['p_hp_storage_trip_psi'] * 6894.76),
+    'V_hp_storage': (['V_hp_storage_cu_ft'], lambda i: i['V_hp_storage_cu_ft'] * 0.0283168),
+    'V_bag_max': (['V_bag_max_cu_ft'], lambda i: i['V_bag_max_cu_ft'] * 0.0283168),
+    'M_hp_storage_min': (['V_hp_storage', 'p_hp_storage_min'],
+                         lambda i: i['V_hp_storage'] * d_from_p_t(i['p_hp_storage_min'], T_env)),
+    'M_hp_storage_trip': (['V_hp_storage', 'p_hp_storage_trip'],
+                          lambda i: i['V_hp_storage'] * d_from_p_t(i['p_hp_storage_trip'], T_env)),
+    'M_bag_max': (['V_bag_max'], lambda i: i['V_bag_max'] * inputs.d_bag),
+    'M_bag_setpoints_high': (['M_bag_max', 'x_bag_setpoints_high'],
+                             lambda i: i['M_bag_max'] * i['x_bag_setpoints_high']),
+    'M_bag_setpoints_low': (['M_bag_max', 'x_bag_setpoints_low'], lambda i: i['M_bag_max'] * i['x_bag_setpoints_low']),
+    'M_portable_dewar_full': (['V_portable_dewar_full_L'],
+                              lambda i: i['V_portable_dewar_full_L'] * 1e-3 * inputs.d_portable_dewar),
+    'M_portable_dewar_min': (['V_portable_dewar_min_L'],
+                             lambda i: i['V_portable_dewar_min_L'] * 1e-3 * inputs.d_portable_dewar),
+    'M_portable_dewar_topup': (['V_portable_dewar_topup_L'],
+                               lambda i: i['V_portable_dewar_topup_L'] * 1e-3 * inputs.d_portable_dewar),
+    'm_portable_dewar_loss': (['x_portable_dewar_loss_day', 'M_portable_dewar_full'],
+                              lambda i: i['x_portable_dewar_loss_day'] * i['M_portable_dewar_full'] / 24 / 3600),
+    'M_portable_dewar_cooldown': (['V_portable_dewar_cooldown_L'],
+                                  lambda i: i['V_portable_dewar_cooldown_L'] * 1e-3 * inputs.d_portable_dewar),
+    'M_linde_dewar_fill_ok': (['M_linde_dewar_min_safe', 'M_portable_dewar_topup'],
+                              lambda i: i['M_linde_dewar_min_safe'] + i['M_portable_dewar_topup']),
+    'd_ucn_4K': (['p_ucn_4K'], lambda i: d_from_p_sl(i['p_ucn_4K'])),
+    'M_ucn_4K_min': (['V_ucn_4K_min_L', 'd_ucn_4K'], lambda i: i['V_ucn_4K_min_L'] * 1e-3 * i['d_ucn_4K']),
+    'M_ucn_4K_max': (['V_ucn_4K_max_L', 'd_ucn_4K'], lambda i: i['V_ucn_4K_max_L'] * 1e-3 * i['d_ucn_4K']),
+    'm_ucn_static': (['v_ucn_static_L_hr', 'd_ucn_4K'], lambda i: i['v_ucn_static_L_hr'] * 1e-3 * i['d_ucn_4K'] / 3600),
+    'm_ucn_beam': (['v_ucn_beam_L_hr', 'd_ucn_4K'], lambda i: i['v_ucn_beam_L_hr'] * 1e-3 * i['d_ucn_4K'] / 3600),
+    'm_ucn_cooldown': (['v_ucn_cooldown_L_hr', 'd_ucn_4K'],
+                       lambda i: i['v_ucn_cooldown_L_hr'] * 1e-3 * i['d_ucn_4K'] / 3600),
+    'm_transfer_line': (['v_transfer_line_L_hr', 'd_linde_dewar'],
+                        lambda i: i['v_transfer_line_L_hr'] * 1e-3 * i['d_linde_dewar'] / 3600),
+    'P_transfer_total': (['P_transfer_line', 'P_transfer_misc'], lambda i: i['P_transfer_line'] + i['P_transfer_misc']),
+    'x_vapor_ucn_4K_JT': (['p_linde_dewar', 'p_ucn_4K'],
+                          lambda i: (h_from_p_sl(i['p_linde_dewar']) - h_from_p_sl(i['p_ucn_4K'])) /
+                                    (h_from_p_sv(i['p_ucn_4K']) - h_from_p_sl(i['p_ucn_4K']))),
+    'q_latent_transfer_line': (['p_linde_dewar', 'p_ucn_4K'],
+                               lambda i: 0.5 * (r_from_p_sl(i['p_linde_dewar']) + r_from_p_sl(i['p_ucn_4K']))),
+    'm_vapor_ucn_4K_Q': (['P_transfer_total', 'q_latent_transfer_line'],
+                         lambda i: i['P_transfer_total'] / i['q_latent_transfer_line']),
+    'm_transfer_line_trickle': (['m_vapor_ucn_4K_Q', 'x_vapor_ucn_4K_JT', 'm_transfer_line'],
+                                lambda i: i['m_vapor_ucn_4K_Q'] + i['x_vapor_ucn_4K_JT'] * i['m_transfer_line']),
+    't_ucn_cooldown': (['t_ucn_cooldown_hrs'], lambda i: i['t_ucn_cooldown_hrs'] * 3600),
+}
+# inputs read by the model as they are
+model_inputs = {'t_rampup_linde_cold', 't_rampup_linde_warm', 'x_linde_production_transfer', 'x_linde_dewar_fill_loss',
+                'm_hp_compressors', 'prediction_window', 't_linde_lookahead', 'fast_mode', 'M_mass_balance_tolerance',
+                't_archive_chunk'}
+# inputs that can be overridden: the ones read by the model and the ones they're calculated from
+overridable_inputs = model_inputs | set(derived_inputs) | {s for sources, _ in derived_inputs.values() for s in sources}
+
+
+def derive_inputs(overrides):
+    # returns overrides together with inputs derived from them, e.g. m_portable_dewar_loss from overridden
+    # x_portable_dewar_loss_day, raises ValueError for overrides the model can't take
+    for name in overrides:
+        if not hasattr(inputs, name):
+            raise ValueError(f'{name} is not in inputs.py')
+        if name in grid_inputs:
+            raise ValueError(f'{name} is baked into the model grid, it can only be changed in inputs.py')
+        if name not in overridable_inputs:
+            raise ValueError(f'{name} is not used by the model, nor anything it uses is calculated from it')
+    derived = dict(overrides)
+    values = collections.ChainMap(derived, vars(inputs))
+    for name, (sources, calculation) in derived_inputs.items():
+        # overridden inputs are taken as they are, even if they're calculated from other overridden inputs
+        if name not in overrides and any(s in derived for s in sources):
+            derived[name] = calculation(values)
+    for name in ['m_hp_compressors', 'x_bag_setpoints_high', 'x_bag_setpoints_low', 'M_bag_setpoints_high',
+                 'M_bag_setpoints_low']:
+        if np.shape(values[name]) != (inputs.N_hp_compressors,):
+            raise ValueError(f'{name} must have one value for each of {inputs.N_hp_compressors} hp compressors')
+    if not np.all(values['M_bag_setpoints_low'] < values['M_bag_setpoints_high']):
+        raise ValueError('low bag setpoints of hp compressors must be below their high setpoints')
+    return derived
+
+
+def new_state(verbose=False):
+    # returns fresh histories, logbooks and counters of a run, shaped like the module globals of main.py they replace
+    return {'linde_storage': np.zeros_like(main.linde_storage),
+            'linde_state': np.zeros_like(main.linde_state),
+            'linde_production': np.zeros_like(main.linde_production),
+            'clamped': np.zeros_like(main.clamped),
+            'linde_state_logbook': {},
+            'hp_comp_state': np.zeros_like(main.hp_comp_state),
+            'hp_comp_run_time': np.zeros_like(main.hp_comp_run_time),
+            'hp_comp_starts': np.zeros_like(main.hp_comp_starts),
+            'dewar_storage': np.zeros_like(main.dewar_storage),
+            'dewar_cooldown': np.zeros_like(main.dewar_cooldown),
+            'dewar_state': np.zeros_like(main.dewar_state),
+            'dewar_state_logbook': {},
+            'purchased_dewar_storage': np.zeros_like(main.purchased_dewar_storage),
+            'purchased_dewar_step': np.full_like(main.purchased_dewar_step, -1),
+            'purchased_dewar_state_logbook': {},
+            'dewars_purchased': c_int32(0),
+            'cmms_state': np.zeros_like(main.cmms_state),
+            'cmms_state_logbook': [],
+            'ucn_state': np.zeros_like(main.ucn_state),
+            'ucn_state_logbook': {},
+            'replay': {},
+            'linde_plan': {},
+            'lookahead_active': c_bool(False),
+            'lookahead_log': [],
+            'linde_held': c_bool(False),
+            'simulated_ahead': c_int32(0),
+            'verbose': c_bool(verbose)}
+
+
+class Simulation:
+    # a single model run, owning its state and inputs that differ from inputs.py
+    # only one simulation runs at a time: its state and inputs are swapped into main.py and inputs.py for each chunk
+    def __init__(self, overrides=None, replay=None, verbose=False):
+        # overrides: {name: value} of inputs.py to use instead, e.g. {'V_bag_max_cu_ft': 1000}
+        #            inputs derived from them are recalculated as inputs.py does, see derive_inputs
+        # replay: measured states driving the run, see historian.replay_states
+        if overrides is None:
+            overrides = {}
+        self.overrides = dict(overrides)
+        self.inputs = derive_inputs(self.overrides) if self.overrides else {}  # inputs swapped in, derived included
+        self.state = new_state(verbose)
+        if replay is not None:
+            self.state['replay'].update(replay)
+        self.step_done = 0  # last simulated step
+        self.stopped = None  # exception that stopped the simulation, it can't go on after it
+        previous = self.swap_in()
+        try:
+            main.initialize()
+        finally:
+            self.swap_out(previous)
+
+    def swap_in(self):
+        # makes main.py work on state and inputs of this simulation, returns what was there before
+        previous = ({name: getattr(main, name) for name in self.state},
+                    {name: getattr(inputs, name) for name in self.inputs})
+        for name, value in self.state.items():
+            setattr(main, name, value)
+        for name, value in self.inputs.items():
+            setattr(inputs, name, value)
+        return previous
+
+    def swap_out(self, previous):
+        # puts back state and inputs returned by swap_in
+        for name, value in previous[0].items():
+            setattr(main, name, value)
+        for name, value in previous[1].items():
+            setattr(inputs, name, value)
+
+    def time(self):
+        # returns time of the last simulated step as unix epoch
+        return main.timestamps[self.step_done]
+
+    def simulate(self, step_to):
+        # simulates steps after the last simulated one up to step_to (not included) or the end of modelled period
+        if self.stopped is not None:
+            raise self.stopped
+        step_from = self.step_done + 1
+        previous = self.swap_in()
+        try:
+            try:
+                for i in range(step_from, min(step_to, main.total_steps)):
+                    main.iterate(i)
+                    self.step_done = i
+            finally:
+                # simulated steps are audited even if iteration stopped, an inconsistency found by the audit comes
+                # before whatever stopped it and replaces it
+                main.audit(step_from, self.step_done + 1)
+        except main.IterationStopped as e:
+            self.stopped = e
+            raise
+        finally:
+            self.swap_out(previous)
+
+    def step(self):
+        # simulates the next step and returns it
+        if self.step_done == main.total_steps - 1:
+            raise main.PeriodEnded(self.step_done + 1, 'end of modelled period')
+        self.simulate(self.step_done + 2)
+        return self.step_done
+
+    def run_until(self, t):
+        # simulates all steps up to time t, either unix epoch or local time string, returns the last simulated step
+        # raises PeriodEnded without simulating anything if t is past the end of modelled period
+        if isinstance(t, str):
+            t = inputs.parse_time(t)
+        step = int((t - inputs.start_time) // main.dt)
+        if step >= main.total_steps:
+            raise main.PeriodEnded(main.total_steps, 'end of modelled period')
+        self.simulate(step + 1)
+        return self.step_done
+
+    def snapshot(self, step_from, step_to):
+        # returns copies of histories between step_from and step_to (not included), with counters as they are now
+        s = self.state
+        return {'step_from': step_from,
+                'step_to': step_to,
+                'timestamps': main.timestamps[step_from:step_to].copy(),
+                'linde_storage': s['linde_storage'][step_from:step_to].copy(),
+                'linde_state': s['linde_state'][step_from:step_to].copy(),
+                'linde_production': s['linde_production'][step_from:step_to].copy(),
+                'hp_comp_state': s['hp_comp_state'][:, step_from:step_to].copy(),
+                'dewar_storage': s['dewar_storage'][:, step_from:step_to].copy(),
+                'dewar_state': s['dewar_state'][:, step_from:step_to].copy(),
+                'purchased_dewar_storage':
+                    s['purchased_dewar_storage'][:s['dewars_purchased'].value, step_from:step_to].copy(),
+                'cmms_state': s['cmms_state'][:, step_from:step_to].copy(),
+                'ucn_state': s['ucn_state'][step_from:step_to].copy(),
+                'dewars_purchased': s['dewars_purchased'].value,
+                'hp_comp_run_time': s['hp_comp_run_time'].copy(),
+                'hp_comp_starts': s['hp_comp_starts'].copy()}
+
+    def stream(self, every=1, until=inputs.end_time):
+        # simulates up to time until, yielding snapshot of every given number of steps as soon as they are simulated
+        # every=1 streams single steps, e.g. every=24*60 streams days of 1 minute steps
+        if isinstance(until, str):
+            until = inputs.parse_time(until)
+        step_until = min(int((until - inputs.start_time) // main.dt) + 1, main.total_steps)
+        while self.step_done + 1 < step_until:
+            step_from = self.step_done + 1
+            self.simulate(min(step_from + every, step_until))
+            yield self.snapshot(step_from, self.step_done + 1)
+
+    def save(self, path):
+        # saves results archive of steps simulated so far, see main.save_results, re-plot it with replot.py
+        previous = self.swap_in()
+        try:
+            main.save_results(path, self.step_done + 1, self.stopped)
+        finally:
+            self.swap_out(previous)